@@ -0,0 +1,259 @@
+#Headless batch mode: scan a dataset, interrogate automatic tags and write a
+#subset from a saved LoRA_info.json without opening a window. Nothing in here
+#may import tkinter, tkinterdnd2 or pynput.
+#
+#Usage: python tag_helper.py batch DATASET [options]
+#
+#Timing stats are printed to stdout as a single JSON object when done. Any
+#other output goes to stderr.
+import sys
+import json
+import time
+import pathlib
+import argparse
+import traceback
+import contextlib
+from os import makedirs, remove
+from os.path import isfile, exists, splitext
+
+import dataset
+import subset
+import tokens
+import interrogation
+from dataset import dataset_index, defaults_resolver, sidecar_pool, walk_images
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="tag_helper.py batch",
+        description="Scan a dataset, interrogate automatic tags and generate "
+                    "a LoRA subset without the GUI.")
+    parser.add_argument("dataset",
+                        help="dataset directory")
+    parser.add_argument("--interrogate", choices=["missing", "all", "none"],
+                        default="missing",
+                        help="which images to interrogate for automatic tags "
+                             "(default: missing)")
+    parser.add_argument("--subset",
+                        help="LoRA_info.json (or a subset folder containing "
+                             "one) with the settings of the subset to write")
+    parser.add_argument("--output", default=str(pathlib.Path().absolute()
+                                                / "lora_subsets"),
+                        help="folder the subset folder is created in "
+                             "(default: ./lora_subsets)")
+    parser.add_argument("--clean", action="store_true",
+                        help="delete files already in the subset folder")
+    parser.add_argument("--store", choices=["create", "export"],
+                        help="create: copy all sidecars into a single "
+                             "metadata file, which the dataset uses from "
+                             "then on. export: write the metadata file back "
+                             "out as sidecars and delete it")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="images run through the interrogator at once "
+                             f"(default: {interrogation.interrogate_batch_size})")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="threads used to read sidecars "
+                             f"(default: {dataset.sidecar_workers}) and to "
+                             "load images for interrogation "
+                             f"(default: {interrogation.interrogate_workers})")
+    parser.add_argument("--stats",
+                        help="also write the timing stats to this file")
+    return parser.parse_args(argv)
+
+
+class batch_run(object):
+    def __init__(self, args):
+        self.args = args
+        self.path = pathlib.Path(args.dataset).absolute()
+        self.image_files = []
+        self.index = None
+        self.resolver = None
+        self.errors = 0
+        self.stats = {"dataset": str(self.path), "timings": {}, "counts": {}}
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stats["timings"][name] = round(time.perf_counter() - start, 4)
+
+    def get_item_from_file(self, path):
+        sidecars = self.index.get_sidecars(path)
+        return dataset.item_from_sidecars(path, sidecars, self.resolver)
+
+    def get_defaults(self, path):
+        defaults = dataset.item_defaults(path)
+        defaults.update(self.resolver.resolve(pathlib.Path(path).parent))
+        return defaults
+
+    #Enumerate images and read (or reuse the index of) all their sidecars
+    def scan(self):
+        with self.timed("scan"):
+            self.index = dataset_index(self.path)
+            self.resolver = defaults_resolver(self.path)
+            self.image_files = list(walk_images(self.path))
+            with sidecar_pool(self.args.workers) as pool:
+                self.index.get_sidecars_many(self.image_files, pool)
+            self.index.save(prune=True)
+        self.stats["counts"]["images"] = len(self.image_files)
+
+    #Move metadata between the sidecars and a single metadata file
+    def convert_store(self):
+        with self.timed("store"):
+            if self.args.store == "create":
+                with sidecar_pool(self.args.workers) as pool:
+                    self.index.create_store(self.image_files, pool)
+            else:
+                self.index.remove_store()
+
+    #Interrogate images and store the tags in their JSON, as the GUI's
+    #"Interrogate All" does
+    def interrogate(self):
+        with self.timed("interrogator_import"):
+            interrogation.import_interrogators()
+
+        batch_size = self.args.batch_size or interrogation.interrogate_batch_size
+        interrogated = 0
+        with self.timed("interrogate"):
+            paths = [p for p in self.image_files
+                     if self.args.interrogate == "all"
+                     or not self.get_item_from_file(p)["automatic_tags"]]
+
+            #Images are decoded and run through the model in the background
+            #while this thread writes the results
+            pipeline = interrogation.interrogate_pipeline(
+                paths, batch_size, self.args.workers, self.index.get_sidecars)
+            pipeline.start()
+            while True:
+                message = pipeline.results.get()
+                if message[0] == "done":
+                    break
+                _, path, caption = message
+                #Not interrogated and no tags to fall back on, e.g. the
+                #interrogator couldn't be imported. Leave the JSON alone.
+                if not caption:
+                    continue
+                try:
+                    item = self.get_item_from_file(path)
+                    item["automatic_tags"] = caption
+                    json_file = splitext(path)[0] + ".json"
+                    dataset.write_item_to_file(
+                        dataset.trim_item(item, self.get_defaults(path)),
+                        json_file, self.index.store)
+                    self.index.invalidate(path)
+                    interrogated += 1
+                except:
+                    print(traceback.format_exc())
+                    print(f"Couldn't interrogate {path}")
+                    self.errors += 1
+            self.index.save()
+        self.stats["counts"]["interrogated"] = interrogated
+        self.stats["interrogate_batch_size"] = batch_size
+        if interrogated:
+            self.stats["interrogate_images_per_second"] = round(
+                interrogated / max(self.stats["timings"]["interrogate"], 1e-9), 2)
+
+    def load_subset_settings(self):
+        info_path = pathlib.Path(self.args.subset)
+        if info_path.is_dir():
+            info_path = info_path / "LoRA_info.json"
+        with open(info_path) as f:
+            loaded = json.load(f)
+        info = dict(subset.default_subset_info)
+        info.update(loaded)
+        info["name"] = '_'.join(info["name"].split())
+        return info
+
+    #Prepare the subset folder, refusing to touch folders that aren't subsets
+    def prepare_subset_path(self, info):
+        subset_path = subset.subset_path_from_info(self.args.output, info)
+        if not exists(subset_path):
+            makedirs(subset_path)
+        elif not subset.load_subset_info(subset_path):
+            raise RuntimeError(
+                f"{subset_path} exists, but does not have valid subset "
+                "information. Aborting to avoid clobbering non-subset directory.")
+        elif self.args.clean:
+            for f in pathlib.Path(subset_path).rglob("*"):
+                if isfile(f):
+                    remove(f)
+        return subset_path
+
+    def generate_subset(self):
+        info = self.load_subset_settings()
+        if not subset.is_valid_output_path(self.args.output, self.path):
+            raise RuntimeError(
+                "Output path must not be an ancestor of dataset path, nor "
+                "may it be within the dataset tree.")
+
+        if info["review_option"] == 1:
+            with self.timed("tokenizer_import"):
+                tokens.import_tokenizer_reqs()
+        elif info["review_option"] > 1:
+            print("Manual review is not available in batch mode. Captions "
+                  "are written without review.")
+
+        if info["interrogate_automatic_tags"] and not interrogation.interrogator_ready:
+            with self.timed("interrogator_import"):
+                interrogation.import_interrogators()
+
+        with self.timed("subset"):
+            subset_path = self.prepare_subset_path(info)
+            subset.save_subset_info(subset_path, info)
+
+            written = 0
+            for path in self.image_files:
+                try:
+                    if subset.add_image_to_subset(
+                            path, self.path, info, subset_path,
+                            lambda path=path: self.get_item_from_file(path),
+                            copy_json=self.index.store is None) is not None:
+                        written += 1
+                except:
+                    print(traceback.format_exc())
+                    print(f"Couldn't write {path} to subset")
+                    self.errors += 1
+
+        self.stats["subset"] = str(subset_path)
+        self.stats["counts"]["subset_images"] = written
+
+    def run(self):
+        with self.timed("total"):
+            try:
+                if not self.path.is_dir():
+                    raise RuntimeError(f"{self.path} is not a directory")
+                self.scan()
+                if self.args.store:
+                    self.convert_store()
+                if self.args.interrogate != "none":
+                    self.interrogate()
+                if self.args.subset:
+                    self.generate_subset()
+            except:
+                print(traceback.format_exc())
+                self.errors += 1
+            finally:
+                if self.index is not None:
+                    self.index.close()
+        self.stats["errors"] = self.errors
+        return self.stats
+
+
+def main(argv = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    #Keep stdout for the stats, libraries print progress as they load
+    with contextlib.redirect_stdout(sys.stderr):
+        stats = batch_run(args).run()
+
+    print(json.dumps(stats))
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(stats, f, indent=4)
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
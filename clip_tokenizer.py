@@ -0,0 +1,216 @@
+#CLIP's byte pair encoding tokenizer, without torch. It uses a copy of the
+#vocabulary file from open_clip that ships with this app, so counting tokens
+#needs no network access and doesn't load torch or any model weights.
+#
+#The BPE logic follows the tokenizer from https://github.com/openai/CLIP
+#(MIT License, Copyright (c) 2021 OpenAI), as copied into open_clip. See
+#LICENSE_clip_tokenizer for the license of both.
+import os
+import gzip
+import html
+import threading
+import importlib.util
+from os.path import join, isfile, dirname, abspath
+
+import regex
+
+try:
+    import ftfy
+except ImportError:
+    ftfy = None
+
+VOCAB_FILENAME = "bpe_simple_vocab_16e6.txt.gz"
+CONTEXT_LENGTH = 77
+
+#Environment variable that can point to a different vocabulary file
+VOCAB_ENV_VAR = "LORA_TAG_HELPER_CLIP_VOCAB"
+
+
+#Path of the BPE vocabulary installed with open_clip, or None
+def open_clip_vocab_path():
+    spec = importlib.util.find_spec("open_clip")
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    for location in spec.submodule_search_locations:
+        path = join(location, VOCAB_FILENAME)
+        if isfile(path):
+            return path
+    return None
+
+
+#Vocabulary to use: the one configured in the environment, else the one
+#shipped next to this file, else open_clip's. None if there is none.
+def default_vocab_path():
+    path = os.environ.get(VOCAB_ENV_VAR)
+    if path:
+        return path
+    path = join(dirname(abspath(__file__)), VOCAB_FILENAME)
+    if isfile(path):
+        return path
+    return open_clip_vocab_path()
+
+
+#Map every byte to a printable character, so BPE works on strings
+def bytes_to_unicode():
+    bs = (list(range(ord("!"), ord("~") + 1))
+          + list(range(ord("¡"), ord("¬") + 1))
+          + list(range(ord("®"), ord("ÿ") + 1)))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+def get_pairs(word):
+    return set(zip(word, word[1:]))
+
+
+#Fix mojibake and HTML entities, as open_clip does before tokenizing
+def fix_text(text):
+    if ftfy is not None:
+        text = ftfy.fix_text(text)
+    return html.unescape(html.unescape(text))
+
+
+#Same text cleanup as open_clip's default ('lower') tokenizer
+def clean_text(text):
+    return " ".join(fix_text(text).split()).lower()
+
+
+class clip_tokenizer(object):
+    def __init__(self, vocab_path = None):
+        vocab_path = vocab_path or default_vocab_path()
+        if vocab_path is None:
+            raise FileNotFoundError(f"Couldn't find {VOCAB_FILENAME}")
+
+        self.byte_encoder = bytes_to_unicode()
+        with gzip.open(vocab_path) as f:
+            merges = f.read().decode("utf-8").split("\n")
+        merges = [tuple(m.split()) for m in merges[1:49152 - 256 - 2 + 1]]
+
+        vocab = list(self.byte_encoder.values())
+        vocab = vocab + [v + "</w>" for v in vocab]
+        vocab.extend("".join(m) for m in merges)
+        vocab.extend(["<start_of_text>", "<end_of_text>"])
+
+        self.encoder = {v: i for i, v in enumerate(vocab)}
+        self.bpe_ranks = {m: i for i, m in enumerate(merges)}
+        self.sot_token = self.encoder["<start_of_text>"]
+        self.eot_token = self.encoder["<end_of_text>"]
+        self.cache = {"<start_of_text>": "<start_of_text>",
+                      "<end_of_text>": "<end_of_text>"}
+        self.pattern = regex.compile(
+            r"""<start_of_text>|<end_of_text>|'s|'t|'re|'ve|'m|'ll|'d|"""
+            r"""[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
+            regex.IGNORECASE)
+
+    def bpe(self, token):
+        if token in self.cache:
+            return self.cache[token]
+        word = tuple(token[:-1]) + (token[-1] + "</w>",)
+        pairs = get_pairs(word)
+
+        if not pairs:
+            return token + "</w>"
+
+        while True:
+            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
+            if bigram not in self.bpe_ranks:
+                break
+            first, second = bigram
+            new_word = []
+            i = 0
+            while i < len(word):
+                try:
+                    j = word.index(first, i)
+                except ValueError:
+                    new_word.extend(word[i:])
+                    break
+                new_word.extend(word[i:j])
+                i = j
+
+                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                    new_word.append(first + second)
+                    i += 2
+                else:
+                    new_word.append(word[i])
+                    i += 1
+            word = tuple(new_word)
+            if len(word) == 1:
+                break
+            pairs = get_pairs(word)
+
+        word = " ".join(word)
+        self.cache[token] = word
+        return word
+
+    #Token ids of text, without the start and end tokens
+    def encode(self, text):
+        tokens = []
+        for token in self.pattern.findall(clean_text(text)):
+            token = "".join(self.byte_encoder[b] for b in token.encode("utf-8"))
+            tokens.extend(self.encoder[t] for t in self.bpe(token).split(" "))
+        return tokens
+
+    #Exact number of tokens in text, without the start and end tokens and
+    #without truncating to the context length
+    def count(self, text):
+        return len(self.encode(text))
+
+    #Token ids of text with the (start, end) character span each came from.
+    #Whitespace never belongs to a token and case doesn't change how words
+    #are split, so the text is matched as is and each word lowercased on its
+    #own. Spans index into text, unless it has HTML entities or mojibake to
+    #fix, in which case they index into the fixed text.
+    def encode_with_offsets(self, text):
+        text = fix_text(text)
+        result = []
+        for match in self.pattern.finditer(text):
+            word = match.group().lower()
+            word_bytes = word.encode("utf-8")
+            byte_start = 0
+            for t in self.bpe("".join(self.byte_encoder[b] for b in word_bytes)).split(" "):
+                byte_end = byte_start + len(t.replace("</w>", ""))
+                start = len(word_bytes[:byte_start].decode("utf-8", errors="ignore"))
+                end = len(word_bytes[:byte_end].decode("utf-8", errors="ignore"))
+                result.append((self.encoder[t],
+                               match.start() + start,
+                               match.start() + end))
+                byte_start = byte_end
+        return result
+
+    #Tokenize like open_clip's tokenizer: start and end tokens added, then
+    #truncated (keeping the end token) or zero padded to the context length.
+    #Returns lists instead of a tensor.
+    def __call__(self, texts, context_length = CONTEXT_LENGTH):
+        if isinstance(texts, str):
+            texts = [texts]
+
+        result = []
+        for text in texts:
+            tokens = [self.sot_token] + self.encode(text) + [self.eot_token]
+            if len(tokens) > context_length:
+                tokens = tokens[:context_length]
+                tokens[-1] = self.eot_token
+            result.append(tokens + [0] * (context_length - len(tokens)))
+        return result
+
+
+#Tokenizers already loaded, by vocabulary path
+tokenizers = {}
+tokenizers_lock = threading.Lock()
+
+
+#Tokenizer for a vocabulary, loaded the first time it's asked for
+def get_tokenizer(vocab_path = None):
+    vocab_path = vocab_path or default_vocab_path()
+    if vocab_path is None:
+        raise FileNotFoundError(f"Couldn't find {VOCAB_FILENAME}")
+    with tokenizers_lock:
+        if vocab_path not in tokenizers:
+            tokenizers[vocab_path] = clip_tokenizer(vocab_path)
+        return tokenizers[vocab_path]
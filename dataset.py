@@ -0,0 +1,634 @@
+import copy
+import json
+import sqlite3
+import hashlib
+import pathlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from os import stat, scandir, remove
+from os.path import splitext, relpath, join, normcase, isfile
+from PIL import Image
+
+from png_text import read_prompt
+
+#Bump when the layout of cached items or known features changes, so stale
+#indexes are rebuilt instead of misread.
+INDEX_VERSION = 3
+INDEX_FILENAME = ".lora_tag_helper_index.sqlite"
+
+#If this file is in a dataset root, the dataset keeps its metadata in it
+#instead of in a .txt and .json next to every image
+STORE_FILENAME = ".lora_tag_helper_store.sqlite"
+
+#Thumbnails are cached in this folder in the dataset root
+THUMBNAIL_DIRNAME = ".lora_tag_helper_thumbnails"
+
+#Number of threads used to read sidecars concurrently. Reading is I/O bound,
+#so more threads than cores pays off on network mounts.
+sidecar_workers = 16
+
+#Use orjson to parse sidecars when it's installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+#Extensions of all image formats PIL can open
+def supported_image_extensions():
+    exts = Image.registered_extensions()
+    return {ex for ex, f in exts.items() if f in Image.OPEN}
+
+
+#Yield the absolute paths of all supported images under root, in the same
+#order as sorting the full list would give, one directory at a time. Uses
+#the type information from os.scandir instead of stat-ing every entry, so the
+#first image is available long before a large tree is fully enumerated.
+def walk_images(root, supported_exts = None):
+    if supported_exts is None:
+        supported_exts = supported_image_extensions()
+
+    def walk(directory):
+        try:
+            with scandir(directory) as it:
+                entries = sorted(it, key=lambda e: normcase(e.name))
+        except OSError:
+            print(traceback.format_exc())
+            return
+
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name != THUMBNAIL_DIRNAME:
+                        yield from walk(directory / entry.name)
+                elif(splitext(entry.name)[1] in supported_exts
+                     and entry.is_file()):
+                    yield directory / entry.name
+            except OSError:
+                print(traceback.format_exc())
+
+    yield from walk(pathlib.Path(root).absolute())
+
+
+#Position of every image in a list built by walk_images, and of the first
+#image under every directory. The walker visits a directory's whole subtree
+#before moving on, so the images under a directory are contiguous and its
+#first image is the first one added below it.
+class image_positions(object):
+    def __init__(self, root = None):
+        self.root = pathlib.Path(root).absolute() if root else None
+        self.files = {}
+        self.directories = {}
+
+    #Record images appended to the list, starting at index start
+    def add(self, image_files, start):
+        for i, f in enumerate(image_files, start):
+            f = pathlib.Path(f)
+            self.files.setdefault(f, i)
+            for p in f.parents:
+                #Ancestors of a known directory are known as well
+                if p in self.directories:
+                    break
+                self.directories[p] = i
+                if p == self.root:
+                    break
+
+    #Index of an image, or None if it's not in the list
+    def find_file(self, path):
+        return self.files.get(pathlib.Path(path).absolute())
+
+    #Index of the first image under a directory, or None if there is none
+    def find_directory(self, path):
+        return self.directories.get(pathlib.Path(path).absolute())
+
+
+#Return (mtime, size) of a file, or a marker if it doesn't exist
+def file_signature(file):
+    try:
+        st = stat(file)
+        return [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        return [0, -1]
+
+
+#Key of an image (or one of its sidecars) relative to the dataset root, or
+#None if it's outside the dataset
+def dataset_key(root, image_file):
+    key = splitext(relpath(image_file, root))[0]
+    if key.startswith(".."):
+        return None
+    return key
+
+
+#Read the raw contents of the .txt and .json sidecars of an image. Either is
+#None if the file doesn't exist.
+def read_sidecar_files(image_file):
+    txt = None
+    txt_file = splitext(image_file)[0] + ".txt"
+    try:
+        with open(txt_file) as f:
+            txt = f.read()
+    except FileNotFoundError:
+        pass
+
+    item = None
+    json_file = splitext(image_file)[0] + ".json"
+    try:
+        with open(json_file) as f:
+            item = f.read()
+    except FileNotFoundError:
+        pass
+
+    return txt, item
+
+
+#Turn the raw .txt and .json contents into a dict of values that override the
+#defaults. The .json wins over the .txt, as it always has.
+def parse_sidecars(txt, item):
+    sidecars = {}
+
+    #If .txt available, read into automated caption
+    if txt is not None:
+        sidecars["automatic_tags"] = ' '.join(txt.split())
+
+    #If available, parse JSON into fields
+    if item is not None:
+        sidecars.update(json_loads(item))
+
+    return sidecars
+
+
+#Read the .txt and .json sidecars of an image into a dict of values that
+#override the defaults
+def read_sidecars(image_file):
+    return parse_sidecars(*read_sidecar_files(image_file))
+
+
+def sidecar_pool(workers = None):
+    return ThreadPoolExecutor(max_workers=workers or sidecar_workers,
+                              thread_name_prefix="sidecars")
+
+
+#Apply func to every item using a thread pool, keeping the input order. A
+#temporary pool is created if none is given.
+def pool_map(func, items, pool = None):
+    if pool is None:
+        with sidecar_pool() as pool:
+            return list(pool.map(func, items))
+    return list(pool.map(func, items))
+
+
+#Read the sidecars of many images concurrently
+def read_sidecars_many(image_files, pool = None):
+    return pool_map(read_sidecars, image_files, pool)
+
+
+#Defaults for an image before any defaults.json is applied
+def item_defaults(path, summary = ""):
+    return {"lora_tag_helper_version": 1,
+            "title":splitext(pathlib.Path(path).name)[0],
+            "artist": "unknown",
+            "style": "photo",
+            "rating": 0,
+            "summary": summary,
+            "features": {},
+            "crop": [0, 0, 1, 1],
+            "automatic_tags": ""}
+
+
+#Defaults for an image, then its sidecars on top
+def item_from_sidecars(path, sidecars, resolver = None, summary = ""):
+    item = item_defaults(path, summary)
+    if resolver is not None:
+        item.update(resolver.resolve(pathlib.Path(path).parent))
+    item.update(sidecars)
+    check_item_version(item)
+    return item
+
+
+def check_item_version(item):
+    try:
+        if item["lora_tag_helper_version"] > 1:
+            print("Warning: file generated by newer version of lora_tag_helper")
+    except:
+        print(traceback.format_exc())
+
+
+#Only keep the values of an item that differ from its defaults
+def trim_item(item, defaults):
+    return {x:item[x] for x in item if x in defaults and item[x] != defaults[x]}
+
+
+#Write an item's JSON, into the metadata store if the dataset has one
+def write_item_to_file(item, json_file, store = None):
+    if store is not None and store.write_item(item, json_file):
+        return
+    with open(json_file, "w") as f:
+        json.dump(item, f, indent=4)
+
+
+def has_metadata_store(root):
+    return isfile(join(str(root), STORE_FILENAME))
+
+
+#All .txt and .json metadata of a dataset in a single SQLite file, for
+#storage where many tiny files are slow. Rows are keyed like the index, hold
+#the raw sidecar contents and a revision that changes on every write, which
+#stands in for the file signatures the index would otherwise check. Images
+#without a row still use their sidecar files.
+class metadata_store(object):
+    def __init__(self, root):
+        self.root = str(root)
+        self.lock = threading.RLock()
+        self.items = {}
+        self.db = sqlite3.connect(join(self.root, STORE_FILENAME),
+                                  check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS items "
+                        "(path TEXT PRIMARY KEY, revision INTEGER, "
+                        "txt TEXT, item TEXT)")
+        self.db.commit()
+        for path, revision, txt, item in self.db.execute(
+                "SELECT path, revision, txt, item FROM items"):
+            self.items[path] = (revision, txt, item)
+
+    def key(self, image_file):
+        return dataset_key(self.root, image_file)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def signature(self, key):
+        return json.dumps(["store", self.items[key][0]])
+
+    def get_sidecars(self, key):
+        _, txt, item = self.items[key]
+        return parse_sidecars(txt, item)
+
+    def put(self, key, txt, item):
+        with self.lock:
+            revision = self.items[key][0] + 1 if key in self.items else 1
+            self.items[key] = (revision, txt, item)
+            self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)",
+                            (key, revision, txt, item))
+
+    #Store an item's JSON. Returns False if the file is outside the dataset.
+    def write_item(self, item, json_file):
+        key = self.key(json_file)
+        if key is None:
+            return False
+        with self.lock:
+            if key in self.items:
+                txt = self.items[key][1]
+            else:
+                #Keep the caption of an image that wasn't imported yet
+                txt = read_sidecar_files(json_file)[0]
+            self.put(key, txt, json.dumps(item, indent=4))
+            self.db.commit()
+        return True
+
+    #Copy the sidecars of the given images into the store
+    def import_sidecars(self, image_files, pool = None):
+        contents = pool_map(read_sidecar_files, image_files, pool)
+        with self.lock:
+            for f, (txt, item) in zip(image_files, contents):
+                if txt is not None or item is not None:
+                    self.put(self.key(f), txt, item)
+            self.db.commit()
+
+    #Write everything in the store back out as sidecar files
+    def export_sidecars(self):
+        with self.lock:
+            for key, (_, txt, item) in self.items.items():
+                stem = join(self.root, key)
+                if txt is not None:
+                    with open(stem + ".txt", "w") as f:
+                        f.write(txt)
+                if item is not None:
+                    with open(stem + ".json", "w") as f:
+                        f.write(item)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+#Merge a directory's own defaults.json values over its parent's resolved
+#defaults. Features accumulate down the tree, everything else is overridden.
+def merge_defaults(parent, own):
+    merged = dict(parent)
+    features = dict(parent.get("features", {}))
+    try:
+        merged.update(own)
+        if "features" in own:
+            features.update(own["features"])
+    except:
+        print(traceback.format_exc())
+    merged["features"] = features
+    return merged
+
+
+#Cache of the cascaded defaults.json values for each directory of a dataset.
+#Each directory is merged over its parent once, and only recomputed when its
+#own defaults.json changes (by mtime and size) or its parent was recomputed.
+#It may be shared between the Tk thread and a background loader.
+class defaults_resolver(object):
+    def __init__(self, root):
+        self.root = pathlib.Path(root).absolute()
+        self.root_parents = set(self.root.parents)
+        self.resolved = {}
+        self.version = 0
+        self.lock = threading.RLock()
+
+    def read_own(self, directory):
+        try:
+            with open(directory / "defaults.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except:
+            print(traceback.format_exc())
+        return {}
+
+    def lookup_parent(self, directory):
+        parent = directory.parent
+        if parent == directory:
+            return 0, {}
+        version, _, _, values = self.lookup(parent)
+        return version, values
+
+    def store(self, directory, parent_version, parent_values, signature, own):
+        self.version += 1
+        entry = (self.version, signature, own,
+                 merge_defaults(parent_values, own))
+        self.resolved[directory] = (parent_version, entry)
+        return entry
+
+    #Return (version, own signature, own values, merged values) for directory
+    def lookup(self, directory):
+        if directory in self.root_parents:
+            return (0, None, {}, {})
+
+        with self.lock:
+            parent_version, parent_values = self.lookup_parent(directory)
+            signature = file_signature(directory / "defaults.json")
+            cached = self.resolved.get(directory)
+            if cached and cached[1][1] == signature:
+                if cached[0] == parent_version:
+                    return cached[1]
+                own = cached[1][2]
+            else:
+                own = self.read_own(directory)
+
+            return self.store(directory, parent_version, parent_values,
+                              signature, own)
+
+    #Cascaded defaults.json values that apply to files in directory
+    def resolve(self, directory):
+        directory = pathlib.Path(directory).absolute()
+        return copy.deepcopy(self.lookup(directory)[3])
+
+    #Replace a directory's own defaults after they were written to disk.
+    #Subdirectories pick up the change the next time they're resolved.
+    def update(self, directory, own):
+        directory = pathlib.Path(directory).absolute()
+        with self.lock:
+            parent_version, parent_values = self.lookup_parent(directory)
+            self.store(directory, parent_version, parent_values,
+                       file_signature(directory / "defaults.json"), own)
+
+
+#Persistent index of sidecar contents and per-directory known features, kept
+#in a SQLite file in the dataset root. Entries are keyed by the image path
+#relative to the dataset and validated against the mtime and size of its
+#sidecars, so reopening a dataset only re-reads files that changed. It may be
+#shared between the Tk thread and a background loader.
+class dataset_index(object):
+    def __init__(self, root):
+        self.root = str(root)
+        self.lock = threading.RLock()
+        self.items = {}
+        self.directories = {}
+        self.prompts = {}
+        self.seen = set()
+        self.dirty_items = set()
+        self.dirty_directories = set()
+        self.dirty_prompts = set()
+        self.signatures = {}
+        self.db = None
+        self.store = None
+
+        try:
+            if has_metadata_store(self.root):
+                self.store = metadata_store(self.root)
+        except:
+            print(traceback.format_exc())
+            print("Couldn't open metadata store. Sidecars will be used instead.")
+
+        try:
+            self.db = sqlite3.connect(join(self.root, INDEX_FILENAME),
+                                      check_same_thread=False)
+            self.load()
+        except:
+            print(traceback.format_exc())
+            print("Couldn't open dataset index. Sidecars will be read directly.")
+            self.items = {}
+            self.directories = {}
+            self.prompts = {}
+            self.db = None
+
+    def load(self):
+        self.db.execute("CREATE TABLE IF NOT EXISTS info "
+                        "(key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute(
+            "SELECT value FROM info WHERE key = 'version'").fetchone()
+        if row is None or int(row[0]) != INDEX_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS items")
+            self.db.execute("DROP TABLE IF EXISTS directories")
+            self.db.execute("DROP TABLE IF EXISTS prompts")
+            self.db.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)",
+                            (str(INDEX_VERSION),))
+        self.db.execute("CREATE TABLE IF NOT EXISTS items "
+                        "(path TEXT PRIMARY KEY, signature TEXT, item TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS directories "
+                        "(path TEXT PRIMARY KEY, signature TEXT, "
+                        "known_features TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS prompts "
+                        "(path TEXT PRIMARY KEY, signature TEXT, prompt TEXT)")
+        self.db.commit()
+
+        for path, signature, item in self.db.execute(
+                "SELECT path, signature, item FROM items"):
+            self.items[path] = (signature, item)
+        for path, signature, known_features in self.db.execute(
+                "SELECT path, signature, known_features FROM directories"):
+            self.directories[path] = (signature, known_features)
+        for path, signature, prompt in self.db.execute(
+                "SELECT path, signature, prompt FROM prompts"):
+            self.prompts[path] = (signature, prompt)
+
+    #Key for an image (or one of its sidecars), or None if outside the dataset
+    def key(self, image_file):
+        return dataset_key(self.root, image_file)
+
+    def in_store(self, key):
+        return self.store is not None and key in self.store
+
+    def signature(self, image_file):
+        key = self.key(image_file)
+        with self.lock:
+            self.seen.add(key)
+            if self.in_store(key):
+                return self.store.signature(key)
+            if key not in self.signatures:
+                stem = splitext(image_file)[0]
+                self.signatures[key] = json.dumps(
+                    file_signature(stem + ".txt") + file_signature(stem + ".json"))
+            return self.signatures[key]
+
+    #Forget cached signatures so the next lookup re-stats the sidecars
+    def invalidate(self, image_file = None):
+        with self.lock:
+            if image_file is None:
+                self.signatures = {}
+            else:
+                self.signatures.pop(self.key(image_file), None)
+
+    #Sidecar values for an image, re-read only if its sidecars changed
+    def get_sidecars(self, image_file):
+        key = self.key(image_file)
+        if self.in_store(key):
+            return self.store.get_sidecars(key)
+        if key is None or self.db is None:
+            return read_sidecars(image_file)
+
+        signature = self.signature(image_file)
+        cached = self.items.get(key)
+        if cached and cached[0] == signature:
+            return json_loads(cached[1])
+
+        sidecars = read_sidecars(image_file)
+        with self.lock:
+            self.items[key] = (signature, json.dumps(sidecars))
+            self.dirty_items.add(key)
+        return sidecars
+
+    #Sidecar values for many images, reading changed ones concurrently
+    def get_sidecars_many(self, image_files, pool = None):
+        return pool_map(self.get_sidecars, image_files, pool)
+
+    #Signature covering every sidecar in a directory plus the defaults.json
+    #files that cascade into it
+    def directory_signature(self, directory, image_files, pool = None):
+        pool_map(self.signature, image_files, pool)
+
+        h = hashlib.sha1()
+        for f in image_files:
+            h.update(self.key(f).encode())
+            h.update(self.signature(f).encode())
+
+        path = pathlib.Path(directory)
+        for p in reversed([path] + list(path.parents)):
+            h.update(str(p).encode())
+            h.update(json.dumps(file_signature(
+                join(self.root, p, "defaults.json"))).encode())
+        return h.hexdigest()
+
+    #Generation prompt stored in an image, re-read only if the image changed
+    def get_prompt(self, image_file):
+        key = self.key(image_file)
+        if key is None or self.db is None:
+            return read_prompt(image_file)
+
+        signature = json.dumps(file_signature(image_file))
+        cached = self.prompts.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+        prompt = read_prompt(image_file)
+        with self.lock:
+            self.prompts[key] = (signature, prompt)
+            self.dirty_prompts.add(key)
+        return prompt
+
+    def get_prompts_many(self, image_files, pool = None):
+        return pool_map(self.get_prompt, image_files, pool)
+
+    def get_known_features(self, directory, signature):
+        cached = self.directories.get(directory)
+        if cached and cached[0] == signature:
+            return json_loads(cached[1])
+        return None
+
+    def set_known_features(self, directory, signature, known_features):
+        with self.lock:
+            self.directories[directory] = (signature, json.dumps(known_features))
+            self.dirty_directories.add(directory)
+
+    #Write changes back to disk. If prune is set, entries for images not
+    #looked up since the index was opened are dropped.
+    def save(self, prune = False):
+        with self.lock:
+            self.save_locked(prune)
+
+    def save_locked(self, prune):
+        if self.db is None:
+            return
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+                [(k, *self.items[k]) for k in self.dirty_items])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                [(k, *self.directories[k]) for k in self.dirty_directories])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO prompts VALUES (?, ?, ?)",
+                [(k, *self.prompts[k]) for k in self.dirty_prompts])
+            if prune:
+                stale = [k for k in self.items if k not in self.seen]
+                self.db.executemany("DELETE FROM items WHERE path = ?",
+                                    [(k,) for k in stale])
+                for k in stale:
+                    del self.items[k]
+                stale = [k for k in self.prompts if k not in self.seen]
+                self.db.executemany("DELETE FROM prompts WHERE path = ?",
+                                    [(k,) for k in stale])
+                for k in stale:
+                    del self.prompts[k]
+            self.db.commit()
+            self.dirty_items = set()
+            self.dirty_directories = set()
+            self.dirty_prompts = set()
+        except:
+            print(traceback.format_exc())
+
+    #Move all sidecars of the dataset into a new metadata store
+    def create_store(self, image_files, pool = None):
+        with self.lock:
+            if self.store is None:
+                self.store = metadata_store(self.root)
+            self.store.import_sidecars(image_files, pool)
+
+    #Write the metadata store back out as sidecars and stop using it
+    def remove_store(self):
+        with self.lock:
+            if self.store is None:
+                return
+            self.store.export_sidecars()
+            self.store.close()
+            self.store = None
+            self.signatures = {}
+            remove(join(self.root, STORE_FILENAME))
+
+    def close(self):
+        self.save()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            if self.store is not None:
+                self.store.close()
+                self.store = None
@@ -0,0 +1,347 @@
+import time
+import threading
+import traceback
+from collections import OrderedDict
+from PIL import Image
+
+from dataset import file_signature
+
+#Upper bound on the memory used by decoded images kept for display
+memory_budget = 256 * 1024 * 1024
+
+#Images that would take more than this share of the budget once decoded are
+#kept as a downsampled proxy, and displayed from that
+proxy_share = 4
+
+#Show images rotated as their EXIF orientation says. Off by default, because
+#crops have always been stored against the pixels as they are in the file.
+#Subset generation honours the same setting when cropping.
+apply_exif_orientation = False
+
+#Number of images decoded ahead of (and behind) the current one
+prefetch_count = 3
+
+#Milliseconds without a resize event before the image is redrawn properly
+resize_delay = 150
+
+
+#Largest size with the image's aspect ratio that fits in the box
+def fit_size(width, height, box_width, box_height):
+    if box_width < 1:
+        box_width = 1
+    if box_height < 1:
+        box_height = 1
+
+    new_width = int(box_height * width / height)
+    new_height = int(box_width * height / width)
+
+    if new_width < 1:
+        new_width = 1
+    if new_height < 1:
+        new_height = 1
+
+    if new_width <= box_width:
+        return new_width, box_height
+    return box_width, new_height
+
+
+#Transpose that undoes each EXIF orientation
+orientation_transposes = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+#EXIF orientation to display an opened image with
+def orientation_of(image):
+    if not apply_exif_orientation:
+        return 1
+    try:
+        return image.getexif().get(0x0112, 1)
+    except:
+        print(traceback.format_exc())
+        return 1
+
+
+#Size of an image once oriented, or of the file's pixels given the size of
+#the oriented image
+def oriented_size(size, orientation):
+    if orientation in (5, 6, 7, 8):
+        return size[1], size[0]
+    return size
+
+
+def apply_orientation(image, orientation):
+    method = orientation_transposes.get(orientation)
+    if method is None:
+        return image
+    return image.transpose(method)
+
+
+#Size to downsample an image to so it takes at most max_bytes decoded, or
+#None if it already fits
+def proxy_size(width, height, bands, max_bytes):
+    nbytes = width * height * bands
+    if nbytes <= max_bytes:
+        return None
+    scale = (max_bytes / nbytes) ** 0.5
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+
+#Decode an image, downsampled if it wouldn't fit in max_bytes. Returns the
+#image and the size of the source image.
+def load_proxy(path, max_bytes = None):
+    with Image.open(path) as image:
+        orientation = orientation_of(image)
+        source_size = oriented_size(image.size, orientation)
+        size = proxy_size(image.width, image.height, len(image.getbands()),
+                          max_bytes or memory_budget // proxy_share)
+        if size is None:
+            image.load()
+            return apply_orientation(image.copy(), orientation), source_size
+        try:
+            image.draft(None, size)
+        except:
+            print(traceback.format_exc())
+        proxy = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        return apply_orientation(proxy, orientation), source_size
+
+
+#The image followed by copies of it at half the size of the one before
+def build_pyramid(image, min_size = 32):
+    levels = [image]
+    while min(levels[-1].size) >= 2 * min_size:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+#Quick, lower quality scaling for frames drawn while the window is being
+#resized. Scales from the smallest level that is still at least as large.
+def preview_resize(levels, size):
+    level = levels[0]
+    for l in levels:
+        if l.width >= size[0] and l.height >= size[1]:
+            level = l
+    return level.resize(size, Image.BILINEAR)
+
+
+#An image decoded and scaled down to fit a display box. Proxies are only
+#scaled from, never shown, so they get no pyramid. Entries never hold a
+#PhotoImage: they're evicted on the prefetch thread, and Tk images may only
+#be made and deleted on the Tk thread, so each window makes its own.
+class display_image(object):
+    def __init__(self, image, source_size, proxy = False):
+        self.image = image
+        self.source_width, self.source_height = source_size
+        if proxy:
+            self.levels = [image]
+        else:
+            self.levels = build_pyramid(image)
+        self.nbytes = sum(l.width * l.height * len(l.getbands())
+                          for l in self.levels)
+
+    def preview(self, box):
+        return preview_resize(
+            self.levels,
+            fit_size(self.source_width, self.source_height, *box))
+
+
+#Decode an image at roughly the size it's shown at. JPEGs are decoded at a
+#reduced scale by the decoder itself (draft), other formats are decoded fully
+#but shrunk with a fast integer reduce before the final LANCZOS pass. The
+#display size is derived from the original size, so crop coordinates, which
+#are relative to the image, mean the same as on the full resolution image.
+#Returns None if the image would still be too large to decode once the
+#draft is applied, in which case it should be displayed from a proxy.
+def decode_display_image(path, box, max_bytes = None):
+    with Image.open(path) as image:
+        orientation = orientation_of(image)
+        source_size = oriented_size(image.size, orientation)
+        size = oriented_size(fit_size(*source_size, *box), orientation)
+        try:
+            image.draft(None, size)
+        except:
+            print(traceback.format_exc())
+        #image.size is now what will actually be decoded
+        if proxy_size(image.width, image.height, len(image.getbands()),
+                      max_bytes or memory_budget // proxy_share):
+            return None
+        resized = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    return display_image(apply_orientation(resized, orientation), source_size)
+
+
+#Least recently used cache of display images, bounded by their memory use
+class image_cache(object):
+    def __init__(self, max_bytes = None):
+        self.max_bytes = max_bytes or memory_budget
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            self.evict()
+
+    #Drop the least recently used entries until the cache is within its
+    #budget. The newest entry is always kept.
+    def evict(self):
+        with self.lock:
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.nbytes = 0
+
+
+#Decodes images for display, from the cache when possible. It's shared by
+#every window that shows dataset or subset images. A background thread
+#decodes the images around the current one, so they're ready before the user
+#navigates to them. An image is never decoded twice at once: asking for one
+#the prefetcher is working on waits for it instead.
+class image_service(object):
+    def __init__(self, max_bytes = None):
+        self.cache = image_cache(max_bytes)
+        self.condition = threading.Condition()
+        self.loading = {}
+        self.wanted = []
+        self.stopped = False
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0
+        self.decode_seconds = 0
+        self.thread = threading.Thread(target=self.run,
+                                       name="image prefetcher",
+                                       daemon=True)
+        self.thread.start()
+
+    #Cache key of an image at a display size. It includes the file's mtime
+    #and size, so an image that was rewritten (e.g. by regenerating a
+    #subset) is decoded again.
+    def key(self, path, box):
+        return (str(path), tuple(box), tuple(file_signature(path)))
+
+    #Display image for path that fits box, decoding it if needed
+    def get(self, path, box):
+        key = self.key(path, box)
+        while True:
+            with self.condition:
+                entry = self.cache.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry
+                event = self.loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.loading[key] = threading.Event()
+                    break
+            event.wait()
+
+        return self.load(key, event)
+
+    def load(self, key, event):
+        try:
+            start = time.perf_counter()
+            entry = self.decode(*key)
+            self.cache.put(key, entry)
+            with self.condition:
+                self.decodes += 1
+                self.decode_seconds += time.perf_counter() - start
+            return entry
+        finally:
+            with self.condition:
+                del self.loading[key]
+            event.set()
+
+    #Images too large for the budget are decoded once into a proxy that is
+    #cached without a display size, and scaled from there for display
+    def decode(self, path, box, signature):
+        max_bytes = self.cache.max_bytes // proxy_share
+        proxy_key = (path, None, signature)
+        proxy = self.cache.get(proxy_key)
+        if proxy is None:
+            entry = decode_display_image(path, box, max_bytes)
+            if entry is not None:
+                return entry
+            proxy = display_image(*load_proxy(path, max_bytes), proxy=True)
+            self.cache.put(proxy_key, proxy)
+
+        resized = proxy.image.resize(
+            fit_size(proxy.source_width, proxy.source_height, *box),
+            Image.LANCZOS, reducing_gap=3.0)
+        return display_image(resized,
+                             (proxy.source_width, proxy.source_height))
+
+    #Bytes of decoded images held by the cache
+    def memory_used(self):
+        return self.cache.nbytes
+
+    #Counters for the status bar. Waiting for an image the prefetcher was
+    #already decoding counts as a hit.
+    def stats(self):
+        with self.condition:
+            requests = self.hits + self.misses
+            return {"hit_rate": self.hits / requests if requests else 0,
+                    "decodes": self.decodes,
+                    "decode_ms": (1000 * self.decode_seconds / self.decodes
+                                  if self.decodes else 0)}
+
+    def set_memory_budget(self, max_bytes):
+        self.cache.set_max_bytes(max_bytes)
+
+    #Replace the queue of images to decode in the background, in order
+    def prefetch(self, paths, box):
+        with self.condition:
+            self.wanted = [self.key(p, box) for p in paths]
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key = self.wanted.pop(0)
+                if key in self.cache or key in self.loading:
+                    continue
+                event = self.loading[key] = threading.Event()
+
+            try:
+                self.load(key, event)
+            except:
+                print(traceback.format_exc())
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,294 @@
+import os
+import time
+import queue
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext
+from PIL import Image
+
+#get_sidecars, if given, reads an image's sidecar values, e.g. through a
+#dataset_index, so captions kept in a metadata store are found too
+def get_automatic_tags_from_txt_file(image_file, get_sidecars = None):
+    if get_sidecars is not None:
+        return get_sidecars(image_file).get("automatic_tags")
+
+    #If .txt available, read into automated caption
+    txt_file = splitext(image_file)[0] + ".txt"
+    try:
+        with open(txt_file) as f:
+            return ' '.join(f.read().split())
+    except FileNotFoundError:
+        pass
+    return None
+
+def import_interrogators():
+    try:
+        try:
+            global tagger, utils, interrogator, use_interrogate, interrogator_ready
+            print("Importing automatic caption interrogators...")
+            import tagger
+            from tagger import utils
+            from tagger import interrogator
+            tagger.utils.refresh_interrogators()
+            print("Done!")
+
+        except:
+            print(traceback.format_exc())
+            print("Couldn't load clip interrogator. Won't interrogate images for automatic tags, only TXT.")
+            use_interrogate = False
+    except:
+        print(traceback.format_exc())
+    interrogator_ready = True
+    
+def do_interrogate(
+        image: Image,
+
+        interrogator: str,
+        threshold: float,
+        additional_tags: str,
+        exclude_tags: str,
+        sort_by_alphabetical_order: bool,
+        add_confident_as_weight: bool,
+        replace_underscore: bool,
+        replace_underscore_excludes: str):
+    
+    if interrogator not in tagger.utils.interrogators:
+        return ['', None, None, f"'{interrogator}' is not a valid interrogator"]
+
+    interrogator: tagger.Interrogator = tagger.utils.interrogators[interrogator]
+
+    postprocess_opts = (
+        threshold,
+        tagger.utils.split_str(additional_tags),
+        tagger.utils.split_str(exclude_tags),
+        sort_by_alphabetical_order,
+        add_confident_as_weight,
+        replace_underscore,
+        tagger.utils.split_str(replace_underscore_excludes)
+    )
+
+    # single process
+    if image is not None:
+        ratings, tags = interrogator.interrogate(image)
+        processed_tags = tagger.interrogator.Interrogator.postprocess_tags(
+            tags,
+            *postprocess_opts
+        )
+
+        return [
+            ', '.join(processed_tags),
+            ratings,
+            tags,
+            ''
+        ]
+    return ['', None, None, '']
+    
+use_interrogate = True
+interrogator_ready = False
+
+#Interrogator and options used for automatic tags
+interrogator_name = "wd14-vit-v2-git"
+interrogate_options = (0.35, "", "", False, False, True, "0_0, (o)_(o), +_+, +_-, ._., <o>_<o>, <|>_<|>, =_=, >_<, 3_3, 6_9, >_o, @_@, ^_^, o_o, u_u, x_x, |_|, ||_||")
+
+#Images run through the model at once when interrogating many images
+interrogate_batch_size = 8
+
+def interrogate_automatic_tags(image_file, get_sidecars = None):
+    if use_interrogate:
+        try:
+            image = Image.open(image_file).convert('RGB')
+            
+            caption = do_interrogate(image, interrogator_name, *interrogate_options)[0]
+            return caption
+        except:
+            print(traceback.format_exc())            
+            return get_automatic_tags_from_txt_file(image_file, get_sidecars)
+    else:
+       return get_automatic_tags_from_txt_file(image_file, get_sidecars)
+
+#The interrogator automatic tags come from, loaded if needed
+def get_interrogator():
+    interrogator = tagger.utils.interrogators[interrogator_name]
+    if not hasattr(interrogator, 'model') or interrogator.model is None:
+        interrogator.load()
+    return interrogator
+
+#Open an image and convert it to the model's input. Safe to call from
+#several threads once get_interrogator has loaded the model.
+def load_for_interrogation(interrogator, image_file):
+    return interrogator.preprocess(Image.open(image_file).convert('RGB'))
+
+#Caption from the confidences interrogate_batch returns for an image
+def caption_from_result(result):
+    threshold, additional_tags, exclude_tags, sort_by_alphabetical_order, \
+        add_confident_as_weight, replace_underscore, replace_underscore_excludes = interrogate_options
+    ratings, tags = result
+    processed_tags = tagger.interrogator.Interrogator.postprocess_tags(
+        tags,
+        threshold,
+        tagger.utils.split_str(additional_tags),
+        tagger.utils.split_str(exclude_tags),
+        sort_by_alphabetical_order,
+        add_confident_as_weight,
+        replace_underscore,
+        tagger.utils.split_str(replace_underscore_excludes))
+    return ', '.join(processed_tags)
+
+#Threads that open and preprocess images for interrogate_pipeline
+interrogate_workers = min(8, os.cpu_count() or 1)
+
+
+#Interrogates many images in stages that overlap: a thread pool opens and
+#preprocesses images, a single thread runs the model on batches of them,
+#and whoever owns the pipeline writes the results. The stages are linked by
+#bounded queues, so only a few batches of images are in memory at a time.
+#
+#Results are posted to the results queue as ("tags", image_file, tags),
+#followed by ("done",) once every image has been interrogated or the
+#pipeline was cancelled. get_sidecars is passed on to
+#get_automatic_tags_from_txt_file and called from the model thread.
+class interrogate_pipeline(object):
+    def __init__(self, image_files, batch_size = None, workers = None,
+                 get_sidecars = None):
+        self.image_files = list(image_files)
+        self.get_sidecars = get_sidecars
+        self.batch_size = batch_size or interrogate_batch_size
+        self.workers = workers or interrogate_workers
+        self.loaded = queue.Queue(maxsize=2 * self.batch_size)
+        self.results = queue.Queue()
+        self.stopped = threading.Event()
+        self.interrogator = None
+        self.start_time = None
+        self.interrogated = 0
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.loader = threading.Thread(target=self.load_images,
+                                       name="interrogation loader",
+                                       daemon=True)
+        self.inferrer = threading.Thread(target=self.run_model,
+                                         name="interrogation model",
+                                         daemon=True)
+        self.loader.start()
+        self.inferrer.start()
+
+    #Stop starting new work. Images already interrogated are still posted.
+    def cancel(self):
+        self.stopped.set()
+
+    #Put on a bounded queue without blocking forever once cancelled
+    def put(self, q, item):
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load(self, image_file):
+        try:
+            return load_for_interrogation(self.interrogator, image_file)
+        except:
+            print(traceback.format_exc())
+            return None
+
+    #Open and preprocess images in order, keeping at most a couple of
+    #batches ahead of the model. Posts (image_file, image) to self.loaded,
+    #then None.
+    def load_images(self):
+        if use_interrogate:
+            try:
+                self.interrogator = get_interrogator()
+            except:
+                print(traceback.format_exc())
+
+        try:
+            if self.interrogator is not None:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    pending = deque()
+                    for f in self.image_files:
+                        if self.stopped.is_set():
+                            break
+                        pending.append((f, pool.submit(self.load, f)))
+                        if len(pending) >= 2 * self.batch_size:
+                            f, future = pending.popleft()
+                            if not self.put(self.loaded, (f, future.result())):
+                                break
+                    while pending and not self.stopped.is_set():
+                        f, future = pending.popleft()
+                        self.put(self.loaded, (f, future.result()))
+                    for _, future in pending:
+                        future.cancel()
+            else:
+                for f in self.image_files:
+                    if self.stopped.is_set():
+                        break
+                    self.put(self.loaded, (f, None))
+        except:
+            print(traceback.format_exc())
+        #Always let the model thread finish
+        while True:
+            try:
+                self.loaded.put(None, timeout=0.1)
+                return
+            except queue.Full:
+                if self.stopped.is_set():
+                    try:
+                        self.loaded.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    #Take whatever has been loaded, up to a batch
+    def next_batch(self):
+        batch = []
+        item = self.loaded.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            item = self.loaded.get()
+        return batch, True
+
+    def run_model(self):
+        try:
+            finished = False
+            while not finished:
+                batch, finished = self.next_batch()
+                if self.stopped.is_set():
+                    continue
+                self.interrogate(batch)
+        except:
+            print(traceback.format_exc())
+        self.results.put(("done",))
+
+    #Images that couldn't be opened, or all of them if the model fails, get
+    #the tags from their TXT, as interrogate_automatic_tags does
+    def interrogate(self, batch):
+        images = [(f, image) for f, image in batch if image is not None]
+        tags = {}
+        if images:
+            try:
+                results = self.interrogator.interrogate_batch(
+                    [image for _, image in images], self.batch_size)
+                for (f, _), result in zip(images, results):
+                    tags[f] = caption_from_result(result)
+            except:
+                print(traceback.format_exc())
+
+        for f, _ in batch:
+            if f not in tags:
+                tags[f] = get_automatic_tags_from_txt_file(f, self.get_sidecars)
+            self.results.put(("tags", f, tags[f]))
+            self.interrogated += 1
+
+    #(done, total, images per second, seconds left) for progress displays
+    def progress(self):
+        done = self.interrogated
+        total = len(self.image_files)
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0
+        rate = done / elapsed if elapsed > 0 else 0
+        remaining = (total - done) / rate if rate > 0 else None
+        return done, total, rate, remaining
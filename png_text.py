@@ -0,0 +1,83 @@
+import re
+import zlib
+import struct
+import traceback
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+#Text chunks larger than this are skipped rather than read
+max_text_chunk = 16 * 1024 * 1024
+
+
+def decode_text_chunk(chunk_type, data):
+    keyword, _, rest = data.partition(b"\0")
+    keyword = keyword.decode("latin-1")
+
+    if chunk_type == b"tEXt":
+        return keyword, rest.decode("latin-1")
+
+    if chunk_type == b"zTXt":
+        return keyword, zlib.decompress(rest[1:]).decode("latin-1")
+
+    #iTXt: compression flag, compression method, language tag and translated
+    #keyword come before the UTF-8 text
+    compressed = rest[0]
+    _, _, rest = rest[2:].partition(b"\0")
+    _, _, text = rest.partition(b"\0")
+    if compressed:
+        text = zlib.decompress(text)
+    return keyword, text.decode("utf-8")
+
+
+#Read the text chunks of a PNG into a dict, like PIL's Image.info, without
+#decoding any pixels. Only the chunks before the image data are read, which
+#is where PIL and stable-diffusion-webui put them. If keyword is given, stops
+#as soon as that chunk is found. Returns an empty dict for files that aren't
+#PNGs.
+def read_png_text(path, keyword = None):
+    text = {}
+    try:
+        #Reads are a few small headers and the text itself, buffering
+        #would only read ahead into the image data
+        with open(path, "rb", buffering=0) as f:
+            if f.read(8) != PNG_SIGNATURE:
+                return text
+
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                length, chunk_type = struct.unpack(">I4s", header)
+
+                if chunk_type in (b"IDAT", b"IEND"):
+                    break
+                if(chunk_type in (b"tEXt", b"zTXt", b"iTXt")
+                   and length <= max_text_chunk):
+                    data = f.read(length)
+                    f.seek(4, 1) #CRC
+                    try:
+                        name, value = decode_text_chunk(chunk_type, data)
+                        text[name] = value
+                        if name == keyword:
+                            break
+                    except:
+                        print(traceback.format_exc())
+                else:
+                    f.seek(length + 4, 1)
+    except:
+        print(traceback.format_exc())
+    return text
+
+
+#Positive prompt from stable-diffusion-webui generation parameters
+def prompt_from_parameters(parameters):
+    prompt = " ".join(parameters.split("Negative prompt: ")[0].split())
+    return re.sub(r"<.*>", "", prompt).strip().strip(",").strip()
+
+
+#Positive prompt stored in an image, or "" if it has none
+def read_prompt(path):
+    try:
+        return prompt_from_parameters(read_png_text(path, "parameters")["parameters"])
+    except KeyError:
+        return ""
@@ -0,0 +1,268 @@
+import re
+import json
+import shutil
+import pathlib
+import traceback
+from os import sep, utime
+from os.path import isfile, splitext, exists, relpath
+from PIL import Image, ImageOps
+
+import tokens
+import interrogation
+import image_service
+from dataset import write_item_to_file
+
+#Settings used for any key missing from a LoRA_info.json
+default_subset_info = {
+    "lora_tag_helper_version": 1,
+    "name": "default",
+    "include_lora_name": True,
+    "include_artist": False,
+    "include_style": False,
+    "include_summary": True,
+    "include_feature": True,
+    "include_other_features": True,
+    "include_automatic_tags": True,
+    "interrogate_automatic_tags": True,
+    "review_option": 1,
+    "truncate_to_tags": False,
+    "steps_per_image": "100",
+    "enable_filtering": False,
+    "filter": "",
+    "filter_rating": False,
+    "minimum_rating": 0
+}
+
+
+#Save an info JSON for a subset to identify it as ours. Interrogation is
+#always saved as disabled, as the subset popup has always done.
+def save_subset_info(path, info):
+    info = dict(info)
+    info["interrogate_automatic_tags"] = False
+    with open(pathlib.Path(path) / "LoRA_info.json", "w") as f:
+        json.dump(info, f, indent=4)
+    utime(path)
+
+
+#Load info JSON from a subset
+def load_subset_info(path):
+    info_path = pathlib.Path(path) / "LoRA_info.json"
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+        return info
+    except:
+        print(traceback.format_exc())
+        return None
+
+
+#Path of a subset folder for the given settings
+def subset_path_from_info(output_path, info):
+    return (pathlib.Path(output_path)
+            / '_'.join([str(info["steps_per_image"]), info["name"]]))
+
+
+#An output path may not contain, or be contained by, the dataset. This is to
+#reduce the chances of clobbering the dataset with the subset.
+def is_valid_output_path(output_path, dataset_path):
+    output_path = pathlib.Path(output_path)
+    dataset_path = pathlib.Path(dataset_path)
+    return not(output_path in dataset_path.parents
+               or dataset_path in output_path.parents
+               or output_path == dataset_path)
+
+
+#Get unique flat name for file in the subset
+def subset_image_name(path, dataset_path, item):
+    tgt_image = relpath(pathlib.Path(path), dataset_path)
+    tgt_parent= relpath(pathlib.Path(tgt_image).parent)
+    tgt_basename = relpath(pathlib.Path(tgt_image).name)
+    tgt_image = tgt_basename
+    tgt_name = "".join(tgt_basename)[:-1]
+    tgt_ext = splitext(tgt_image)[-1]
+
+    if(tgt_name != item["title"] and item["title"]):
+        tgt_image = str(pathlib.Path(tgt_parent) / item["title"]) + tgt_ext
+
+    tgt_image = tgt_image.replace(sep, "_")
+    i = 2
+    while exists(tgt_image):
+        tgt_image = splitext(tgt_image)[0] + f"_{i}" + tgt_ext
+
+    return tgt_image
+
+
+#Assemble the caption for an item, before duplicate components are removed
+def build_caption(item, info):
+    caption = ""
+    if info["include_lora_name"]:
+        caption += info["name"] + ", "
+
+    if info["include_style"] and item["style"]:
+        caption += item["style"]
+
+        if info["include_artist"]:
+            caption += " by "
+        else:
+            caption += ", "
+
+    if(info["include_artist"]
+       and item["artist"]):
+        caption += item["artist"] + ", "
+
+    if info["include_summary"] and item["summary"]:
+        caption += item["summary"] + ", "
+
+    if(info["include_feature"]
+       and info["name"] in item["features"]):
+        feature = item["features"][info["name"]]
+        if feature == "":
+            feature = info["name"]
+        caption += feature + ", "
+
+    if info["include_other_features"]:
+        for f in item["features"]:
+            if f != info["name"] and item["features"][f]:
+                feature = item["features"][f]
+                if feature == "":
+                    feature = f
+                caption += feature + ", "
+
+    if info["include_automatic_tags"] and item["automatic_tags"]:
+        caption += item["automatic_tags"]
+
+    if caption.endswith(", "):
+        caption = caption[:-2]
+
+    return caption
+
+
+#Drop components contained in another component of the caption
+def remove_duplicate_components(caption):
+    components = caption.split(",")
+
+    unique_components_forward = []
+    for c in components:
+        found = False
+        for u_c in unique_components_forward:
+            if c.strip().lower() in u_c.strip().lower():
+                found = True
+        if not found:
+            unique_components_forward.append(c.strip())
+
+    unique_components = []
+    for c in reversed(unique_components_forward):
+        found = False
+        for u_c in unique_components:
+            if c.strip().lower() in u_c.strip().lower():
+                found = True
+        if not found:
+            unique_components.append(c.strip())
+
+    return ", ".join(reversed(unique_components))
+
+
+#Check a caption against the subset filter (AND, OR, NOT and commas)
+def caption_matches_filter(caption, info):
+    filtered_components_or = re.split(",| OR ", info["filter"])
+    match = False
+
+    for c in filtered_components_or:
+        #Handle the AND operator
+        match_and = True
+        component_and = c.split(" AND ")
+        for c_and in component_and:
+            invert = False
+            while c_and.strip().startswith("NOT "):
+                c_and = c_and[4:]
+                invert = not invert
+
+            start_index = 1 if c_and in info["name"] and info["include_lora_name"] else 0
+            filter_caption = ",".join(caption.split(",")[start_index:])
+
+            #Handle the NOT operator
+            cur_match_and = c_and.strip().lower() in filter_caption.lower()
+            if invert:
+                cur_match_and = not cur_match_and
+            match_and &= cur_match_and
+
+        #Handle the OR operator or comma (treated equivalently)
+        match |= match_and
+
+    return match
+
+
+#Write the caption, (cropped) image and JSON of one item to the subset.
+#get_json_item is only called if the image has no JSON sidecar to copy, or
+#copy_json is False because the dataset keeps its metadata in a store.
+def write_subset_item(path, item, caption, subset_path, tgt_image,
+                      get_json_item, copy_json = True):
+    tgt_prefix = splitext(tgt_image)[0]
+
+    #Save .txt to subset folder
+    with open(str(subset_path / tgt_prefix) + ".txt", "w") as f:
+        f.write(" ".join(caption.split()))
+
+    #Crop image and output to subset folder
+    crop = item["crop"]
+    if crop != [0, 0, 1, 1]:
+        with Image.open(path) as cropped_img:
+            #Crops are relative to the image as it was displayed
+            if image_service.apply_exif_orientation:
+                cropped_img = ImageOps.exif_transpose(cropped_img)
+            cropped_img = cropped_img.crop(
+                (crop[0] * cropped_img.width,
+                 crop[1] * cropped_img.height,
+                 crop[2] * cropped_img.width,
+                 crop[3] * cropped_img.height))
+            cropped_img.save(subset_path / tgt_image)
+    else:
+        shutil.copy2(path, subset_path / tgt_image)
+
+    #Copy JSON to subset folder
+    json_file = "".join(splitext(path)[:-1]) + ".json"
+    target_json = str(subset_path / tgt_prefix) + ".json"
+    try:
+        if copy_json and isfile(json_file):
+            shutil.copy2(json_file, target_json)
+        else:
+            write_item_to_file(get_json_item(), target_json)
+    except:
+        print(traceback.format_exc())
+        print(f"Warning: Could not write JSON file {target_json}")
+
+    return subset_path / tgt_image
+
+
+#Caption and write one dataset image into a subset, as set up by info. This
+#is the whole per-image step of subset generation, shared by the subset
+#window and batch mode. get_item returns the image's item, freshly loaded.
+#Returns the path of the written image, or None if it was filtered out.
+def add_image_to_subset(path, dataset_path, info, subset_path, get_item,
+                        copy_json = True):
+    item = get_item()
+    tgt_image = subset_image_name(path, dataset_path, item)
+
+    try:
+        if info["interrogate_automatic_tags"] and not item["automatic_tags"]:
+            item["automatic_tags"] = interrogation.interrogate_automatic_tags(path)
+    except:
+        print(traceback.format_exc())
+
+    caption = build_caption(item, info)
+
+    #If this item doesn't match the filter, skip it.
+    if info["enable_filtering"] and not caption_matches_filter(caption, info):
+        return None
+
+    caption = remove_duplicate_components(caption)
+
+    if info["filter_rating"] and item["rating"] < info["minimum_rating"]:
+        return None
+
+    if info["review_option"] == 1: #Auto-truncate
+        caption = tokens.truncate_string_to_max_tokens(
+            caption, to_tags=info["truncate_to_tags"])
+
+    return write_subset_item(path, item, caption, subset_path, tgt_image,
+                             get_item, copy_json)
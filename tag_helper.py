@@ -1,17 +1,24 @@
-from os import listdir, makedirs, walk, getcwd, utime, remove, sep
+#Run headless batch mode before anything pulls in tkinter
+import sys
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == "batch":
+    import batch
+    sys.exit(batch.main(sys.argv[2:]))
+
+from os import listdir, makedirs, walk, getcwd, remove
 from os.path import isfile, join, splitext, exists, getmtime, relpath
 import time
 import threading
-import shutil
 import pathlib
-import re
+import queue
 import traceback
+from collections import deque
 from PIL import ImageTk, Image
 import json
 
 from tkinterdnd2 import DND_FILES, TkinterDnD
 from tkinter.messagebox import askyesno, showinfo, showwarning, showerror
 import tkinter.filedialog
+import tkinter.simpledialog
 import tkinter.ttk
 import tkinter.font
 import tkinter as tk
@@ -23,13 +30,31 @@ from pprint import pprint
 
 import spacy
 
-import tagger
+import tokens
+import interrogation
+from tokens import (import_tokenizer_reqs, num_tokens_from_string, num_tokens_many,
+                    truncate_string_to_max_tokens)
+from interrogation import import_interrogators, interrogate_automatic_tags
+from subset import (add_image_to_subset, is_valid_output_path,
+                    load_subset_info, save_subset_info)
+import image_service
+from image_service import fit_size
+from thumbnails import thumbnail_cache
+from png_text import read_prompt
+import dataset
+from dataset import (dataset_index, defaults_resolver, image_positions, item_defaults,
+                     read_sidecars, read_sidecars_many, sidecar_pool,
+                     walk_images)
 
 treeview_separator = "\u2192"
 
 BALLOT_BOX = "\u2610"
 BALLOT_BOX_WITH_X = "\u2612"
 
+#Color of the area outside the crop, and the size of the tile it's filled with
+CROP_SHADE = (255, 0, 0, 128)
+CROP_TILE_SIZE = 64
+
 #TODO:
 #Eventually: Batch rename/delete feature...Alt click on feature?
 #Eventually: generate output dataset optionally without .jsons, organized in various ways
@@ -153,186 +178,16 @@ class TtkCheckList(ttk.Treeview):
             self.uncheck(c)
 
 
-def get_automatic_tags_from_txt_file(image_file):
-    #If .txt available, read into automated caption
-    txt_file = splitext(image_file)[0] + ".txt"
-    try:
-        with open(txt_file) as f:
-            return ' '.join(f.read().split())
-    except FileNotFoundError:
-        pass
-    return None
-
-use_clip = False
-tokenizer_ready = False
-def import_tokenizer_reqs():
-    global tokenizer_ready
-    try:
-        try:
-            global torch, open_clip, Image, model, preprocess, tokenizer, use_clip
-            print("Importing Tokenizer...")
-            import torch
-            import open_clip
-            from PIL import Image
-
-            model, _, preprocess = open_clip.create_model_and_transforms('ViT-L-14', pretrained='laion400m_e32')
-            tokenizer = open_clip.get_tokenizer('ViT-L-14')
-
-            use_clip = True
-            print("Done!")
-
-        except:
-            print("Done!")
-            print(traceback.format_exc())
-            print("Couldn't load torch or clip, falling back to tiktoken. Token count will be less accurate.")
-            import tiktoken
-    except:
-        print(traceback.format_exc())
-    tokenizer_ready = True
-
 nlp = None
+nlp_lock = threading.Lock()
 def do_get_pos(string):
     global nlp
-    if not nlp:
-        print("Loading natural language processing model...")
-        nlp = spacy.load("en_core_web_sm")        
-    return nlp(string)
-
-#Return approximate number of tokens in string (seems to err on the high side)
-def num_tokens_from_string(string: str, encoding_name: str= None) -> int:
-    """Returns the number of tokens in a text string."""
-    if use_clip:
-        def raw_get_tokens(strings):
-            token_list = [list(x) for x in list(tokenizer(strings))]
-            for tl in token_list:
-                while tl[-1] == 0:
-                    tl.pop()
-            return token_list
-
-        #The tokenizer saturates at 77 tokens. Therefore, split the string
-        #until each returned value is less than 77 tokens to get a valid answer.
-        chunks = [string]
-        token_chunks = raw_get_tokens(chunks)
-        found_77 = len(token_chunks[0]) == 77
-
-        while found_77:
-            new_chunks = []
-            for s in chunks:
-                split_s = s.split()
-                joiner = " "
-                if len(split_s) == 1:
-                    split_s = s
-                    joiner = ""
-                left_s = joiner.join(split_s[:int(len(split_s) / 2)])
-                right_s =joiner.join(split_s[int(len(split_s) / 2):])
-                new_chunks.append(left_s)
-                new_chunks.append(right_s)
-            chunks = new_chunks
-
-            new_token_chunks = raw_get_tokens(chunks)
-            token_chunks = new_token_chunks
-            found_77 = False
-            for t in token_chunks:
-                if len(t) == 77:
-                    found_77 = True
-
-        sum_tokens = 0
-        for t in token_chunks:
-            sum_tokens += len(t) - 2 #Each chunk has a start/end token.
-
-        return sum_tokens
-    else:
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
-
-
-def import_interrogators():
-    try:
-        try:
-            global tagger, utils, interrogator, use_interrogate, interrogator_ready
-            print("Importing automatic caption interrogators...")
-            import tagger
-            from tagger import utils
-            from tagger import interrogator
-            tagger.utils.refresh_interrogators()
-            print("Done!")
-
-        except:
-            print(traceback.format_exc())
-            print("Couldn't load clip interrogator. Won't interrogate images for automatic tags, only TXT.")
-            use_interrogate = False
-    except:
-        print(traceback.format_exc())
-    interrogator_ready = True
-    
-def do_interrogate(
-        image: Image,
-
-        interrogator: str,
-        threshold: float,
-        additional_tags: str,
-        exclude_tags: str,
-        sort_by_alphabetical_order: bool,
-        add_confident_as_weight: bool,
-        replace_underscore: bool,
-        replace_underscore_excludes: str):
-    
-    if interrogator not in tagger.utils.interrogators:
-        return ['', None, None, f"'{interrogator}' is not a valid interrogator"]
-
-    interrogator: tagger.Interrogator = tagger.utils.interrogators[interrogator]
-
-    postprocess_opts = (
-        threshold,
-        tagger.utils.split_str(additional_tags),
-        tagger.utils.split_str(exclude_tags),
-        sort_by_alphabetical_order,
-        add_confident_as_weight,
-        replace_underscore,
-        tagger.utils.split_str(replace_underscore_excludes)
-    )
-
-    # single process
-    if image is not None:
-        ratings, tags = interrogator.interrogate(image)
-        processed_tags = tagger.Interrogator.postprocess_tags(
-            tags,
-            *postprocess_opts
-        )
-
-        return [
-            ', '.join(processed_tags),
-            ratings,
-            tags,
-            ''
-        ]
-    return ['', None, None, '']
-    
-use_interrogate = True
-interrogator_ready = False
-
-def interrogate_automatic_tags(image_file):
-    if use_interrogate:
-        try:
-            image = Image.open(image_file).convert('RGB')
-            
-            caption = do_interrogate(image, "wd14-vit-v2-git", 0.35, "", "", False, False, True, "0_0, (o)_(o), +_+, +_-, ._., <o>_<o>, <|>_<|>, =_=, >_<, 3_3, 6_9, >_o, @_@, ^_^, o_o, u_u, x_x, |_|, ||_||")[0]
-            return caption
-        except:
-            print(traceback.format_exc())            
-            return get_automatic_tags_from_txt_file(image_file)
-    else:
-       return get_automatic_tags_from_txt_file(image_file)
-    
-
-def truncate_string_to_max_tokens(string : str):
-    while num_tokens_from_string(string.strip(), "gpt2") > 75:
-        string = " ".join(string.split()[:-1])
-
-    while string.endswith(","):
-        string = string[:-1]
-    return string
+    #Also called from the background dataset loader
+    with nlp_lock:
+        if not nlp:
+            print("Loading natural language processing model...")
+            nlp = spacy.load("en_core_web_sm")        
+        return nlp(string)
 
 
 class save_defaults_popup(object):
@@ -574,8 +429,12 @@ class save_defaults_popup(object):
             showerror(parent=self.top, title="Error", message="Output path must exist")
             return
 
+        defaults = self.get_defaults_from_ui()
+        if defaults is None:
+            return
         with open(abs_path / "defaults.json", "w") as f:
-            json.dump(self.get_defaults_from_ui(), f, indent=4)
+            json.dump(defaults, f, indent=4)
+        self.parent.defaults_resolver.update(abs_path, defaults)
         self.close()
 
     def cancel(self, event = None):
@@ -614,7 +473,7 @@ class save_defaults_popup(object):
 class manually_review_subset_popup(object):
     def __init__(self, parent, subset_path, image_files, review_all):
         try:
-            if not tokenizer_ready:
+            if not tokens.tokenizer_ready:
                 showerror(parent=parent.top,
                             title="Not ready",
                             message="The tokenizer is not yet ready.")
@@ -625,24 +484,23 @@ class manually_review_subset_popup(object):
             self.dataset_path = self.parent.parent.path
             self.subset_path = subset_path
             self.file_index = 0
-            self.image_files = image_files.copy()
             self.icon_image = Image.open("icon.png")
-            if not review_all:
-                for f in reversed(image_files):
-                    caption_file = "".join(splitext(f)[:-1]) + ".txt"
-                    caption = self.get_caption_from_file(caption_file)
-                    if num_tokens_from_string(caption, "gpt2") <= 75:
-                        self.image_files.remove(f)
-
-            if len(self.image_files) == 0:
-                showinfo(parent=parent.top,
-                         title="No such files",
-                         message="No images had more than 75 tokens.")
-                self.top = tk.Toplevel(self.parent.top)
-                self.close()
-                return
 
-            self.icon_image = Image.open("icon.png")
+            #Captions are counted in the background, and images are added
+            #to the review queue as they're found to be over the limit
+            self.checked_files = 0
+            self.files_to_check = len(image_files)
+            self.check_results = queue.Queue()
+            self.check_cancelled = threading.Event()
+            if review_all:
+                self.image_files = image_files.copy()
+                self.checking = False
+            else:
+                self.image_files = []
+                self.checking = True
+                threading.Thread(target=self.check_captions,
+                                 args=(image_files.copy(),),
+                                 daemon=True).start()
 
             self.create_ui()
         except:
@@ -652,7 +510,114 @@ class manually_review_subset_popup(object):
         self.top = tk.Toplevel(self.parent.top)
         self.top.title("Manually review captions")
         self.create_primary_frame()
-        self.set_ui(self.file_index)
+        if len(self.image_files) > 0:
+            self.set_ui(self.file_index)
+        else:
+            self.show_waiting()
+        if self.checking:
+            self.top.after(100, self.poll_caption_check)
+
+    #Count the tokens in captions in batches, posting the images that are
+    #over the limit. Runs in a background thread.
+    def check_captions(self, image_files, batch_size = 256):
+        for i in range(0, len(image_files), batch_size):
+            if self.check_cancelled.is_set():
+                return
+            batch = image_files[i:i + batch_size]
+            captions = []
+            for f in batch:
+                caption = ""
+                try:
+                    with open("".join(splitext(f)[:-1]) + ".txt") as caption_file:
+                        caption = caption_file.read()
+                except:
+                    print(traceback.format_exc())
+                captions.append(caption)
+
+            over = []
+            try:
+                counts = num_tokens_many(captions, "gpt2")
+                over = [f for f, c in zip(batch, counts) if c > 75]
+            except:
+                print(traceback.format_exc())
+            self.check_results.put((over, len(batch)))
+        self.check_results.put(None)
+
+    #Add images found by check_captions to the queue
+    def poll_caption_check(self):
+        try:
+            if not self.top.winfo_exists():
+                self.check_cancelled.set()
+                return
+        except:
+            self.check_cancelled.set()
+            return
+
+        was_empty = len(self.image_files) == 0
+        while True:
+            try:
+                result = self.check_results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.checking = False
+                break
+            over, checked = result
+            self.image_files.extend(over)
+            self.checked_files += checked
+
+        if len(self.image_files) > 0:
+            if was_empty:
+                self.file_index = 0
+                self.set_ui(self.file_index)
+            else:
+                self.update_statusbar()
+                self.update_nav_buttons()
+        elif not self.checking:
+            showinfo(parent=self.top,
+                     title="No such files",
+                     message="No images had more than 75 tokens.")
+            self.close()
+            return
+        else:
+            self.show_waiting()
+
+        if self.checking:
+            self.top.after(100, self.poll_caption_check)
+
+    #Shown while no image over the limit has been found yet
+    def show_waiting(self):
+        self.image = self.icon_image
+        self.image_path = None
+        self.display = None
+        self.image_resizer()
+        self.caption_textbox.delete("1.0", "end")
+        self.token_count_label.configure(text="Tokens: 0 / 75")
+        self.prev_file_btn["state"] = "disabled"
+        self.next_file_btn["state"] = "disabled"
+        self.statusbar_text.set(
+            f"Looking for captions over 75 tokens: "
+            f"{self.checked_files}/{self.files_to_check} checked")
+
+    def update_statusbar(self):
+        status = (f"Image {1 + self.file_index}/{len(self.image_files)}: "
+                  f"{relpath(pathlib.Path(self.image_files[self.file_index]), self.parent.parent.path)}")
+        if self.checking:
+            status += (f" (still checking captions: "
+                       f"{self.checked_files}/{self.files_to_check})")
+        self.statusbar_text.set(status)
+
+    #Enable/disable buttons as appropriate
+    def update_nav_buttons(self):
+        if self.file_index > 0:
+            self.prev_file_btn["state"] = "normal"
+        else:
+            self.prev_file_btn["state"] = "disabled"
+
+        if self.file_index < len(self.image_files) - 1:
+            self.next_file_btn["state"] = "normal"
+        else:
+            self.next_file_btn["state"] = "disabled"
 
  
     #Create primary frame
@@ -706,7 +671,13 @@ class manually_review_subset_popup(object):
                                     image=self.framed_image, 
                                     bd=0)
         self.image_label.grid(row=0, column=0, sticky="nsew")
-        self.sizer_frame.bind("<Configure>", self.image_resizer)
+        self.image_service = self.parent.parent.image_service
+        self.image_path = None
+        self.display = None
+        self.photo = None
+        self.photo_display = None
+        self.resize_job = None
+        self.sizer_frame.bind("<Configure>", self.schedule_image_resize)
 
     #Create the frame for form display
     def create_form_frame(self):
@@ -783,22 +754,7 @@ class manually_review_subset_popup(object):
 
         #Clear the UI and associated variables
         self.file_index = 0
-        self.image_files = []
-
-
-        #Get supported extensions
-        exts = Image.registered_extensions()
-        supported_exts = {ex for ex, f in exts.items() if f in Image.OPEN}
-
-        #Get list of filenames matching those extensions
-        files = [pathlib.Path(f).absolute()
-                 for f in pathlib.Path(self.path).rglob("*")
-                  if isfile(join(self.path, f))]
-        
-        self.image_files = [
-            f for f in files if splitext(f)[1] in supported_exts]  
-
-        self.image_files.sort()
+        self.image_files = list(walk_images(self.subset_path))
 
         #Point UI to beginning of queue
         if(len(self.image_files) > 0):
@@ -824,35 +780,58 @@ class manually_review_subset_popup(object):
         return False
 
     def load_image(self, f):
-        self.image = Image.open(f)
+        self.image_path = f
         self.image_resizer()
 
+    #Decode the next and previous images in the background
+    def prefetch_images(self, index):
+        n = image_service.prefetch_count
+        ahead = self.image_files[index + 1:index + 1 + n]
+        behind = self.image_files[max(index - n, 0):index][::-1]
+        self.image_service.prefetch(ahead + behind, self.image_box())
+
+    def image_box(self):
+        return (max(self.image_frame.winfo_width() - 4, 1),
+                max(self.image_frame.winfo_height() - 4, 1))
+
+    #Draw a quick preview while the window is resized, and the proper image
+    #once it hasn't been resized for a moment
+    def schedule_image_resize(self, e = None):
+        if self.resize_job is not None:
+            self.top.after_cancel(self.resize_job)
+        self.resize_job = self.top.after(image_service.resize_delay,
+                                         self.image_resizer)
+        if self.display is not None:
+            try:
+                self.framed_image = ImageTk.PhotoImage(
+                    self.display.preview(self.image_box()))
+                self.image_label.configure(image=self.framed_image)
+            except:
+                print(traceback.format_exc())
+
+    #PhotoImage of a display image, made on the Tk thread and kept by this
+    #window only while it's the image shown
+    def display_photo(self, display):
+        if display is not self.photo_display:
+            self.photo = ImageTk.PhotoImage(display.image)
+            self.photo_display = display
+        return self.photo
+
     #Resize image to fit resized window
     def image_resizer(self, e = None):
-        tgt_width = self.image_frame.winfo_width() - 4
-        tgt_height = self.image_frame.winfo_height() - 4
-
-        if tgt_width < 1:
-            tgt_width = 1
-        if tgt_height < 1:
-            tgt_height = 1
-
-        new_width = int(tgt_height * self.image.width / self.image.height)
-        new_height = int(tgt_width * self.image.height / self.image.width)
-
-        if new_width < 1:
-            new_width = 1
-        if new_height < 1:
-            new_height = 1
-
-        if new_width <= tgt_width:
-            resized_image = self.image.resize(
-                (new_width, tgt_height), 
-                Image.LANCZOS)
-        else:
-            resized_image = self.image.resize(
-                (tgt_width, new_height), 
-                Image.LANCZOS)
+        self.resize_job = None
+        box = self.image_box()
+        if self.image_path is not None:
+            try:
+                self.display = self.image_service.get(self.image_path, box)
+                self.framed_image = self.display_photo(self.display)
+                self.image_label.configure(image=self.framed_image)
+                return
+            except:
+                print(traceback.format_exc())
+        resized_image = self.image.resize(
+            fit_size(self.image.width, self.image.height, *box),
+            Image.LANCZOS)
         self.framed_image = ImageTk.PhotoImage(resized_image)
         self.image_label.configure(image=self.framed_image)
 
@@ -905,6 +884,9 @@ class manually_review_subset_popup(object):
 
     #Add UI elements for next file button
     def first_file(self, event = None):
+        if len(self.image_files) == 0:
+            return
+
         #Pop up unsaved data dialog if needed
         if self.save_unsaved_popup():
             return
@@ -917,6 +899,9 @@ class manually_review_subset_popup(object):
 
     #Add UI elements for next file button
     def last_file(self, event = None):
+        if len(self.image_files) == 0:
+            return
+
         #Pop up unsaved data dialog if needed
         if self.save_unsaved_popup():
             return
@@ -933,6 +918,8 @@ class manually_review_subset_popup(object):
             self.close()
             return
         self.image = self.icon_image
+        self.image_path = None
+        self.display = None
         self.framed_image = ImageTk.PhotoImage(self.image)
         self.image_label.configure(image=self.framed_image)
         self.caption_textbox.delete("1.0", "end")
@@ -962,22 +949,10 @@ class manually_review_subset_popup(object):
 
         f = self.image_files[index]        
         self.load_image(f)
+        self.prefetch_images(index)
         
-        self.statusbar_text.set(
-            f"Image {1 + self.file_index}/{len(self.image_files)}: "
-            f"{relpath(pathlib.Path(self.image_files[self.file_index]), self.parent.parent.path)}")
-        
-        #Enable/disable buttons as appropriate
-        if self.file_index > 0:
-            self.prev_file_btn["state"] = "normal"
-        else:
-            self.prev_file_btn["state"] = "disabled"
-
-        if self.file_index < len(self.image_files) - 1:
-            self.next_file_btn["state"] = "normal"
-        else:
-            self.next_file_btn["state"] = "disabled"
-            
+        self.update_statusbar()
+        self.update_nav_buttons()
         self.update_token_count()
         self.top.update_idletasks()
 
@@ -1031,13 +1006,16 @@ class manually_review_subset_popup(object):
     def auto_truncate(self, event = None):
         caption = self.get_caption_from_ui()
 
-        truncated = truncate_string_to_max_tokens(caption)
+        truncated = truncate_string_to_max_tokens(
+            caption, to_tags=self.parent.truncate_to_tags.get())
         self.caption_textbox.delete("1.0", "end")
         self.caption_textbox.insert("1.0", truncated)
         return "break"
         
     #Add UI elements for save JSON button
     def save_txt(self, event = None):
+        if len(self.image_files) == 0:
+            return
         self.write_caption_to_file(
             self.get_caption_from_ui(),
             "".join(splitext(self.image_files[self.file_index])[:-1]) + ".txt")
@@ -1045,10 +1023,17 @@ class manually_review_subset_popup(object):
         if self.file_index >= len(self.image_files):
             self.file_index -= 1
         if self.file_index < 0:
+            if self.checking:
+                #More may still be found
+                self.file_index = 0
+                self.show_waiting()
+                return
             self.close()
+            return
         self.set_ui(self.file_index)
 
     def close(self, event = None):
+        self.check_cancelled.set()
         self.top.grab_release()
         self.top.destroy()
 
@@ -1238,6 +1223,15 @@ class generate_lora_subset_popup(object):
            variable=self.review_option, 
            value=3).grid(row=3, column=0, sticky="w")
 
+        #Checkbox to only cut captions between comma separated tags
+        self.truncate_to_tags = tk.BooleanVar(None)
+        self.truncate_to_tags.set(False)
+        truncate_to_tags_chk = tk.Checkbutton(
+            review_group,
+            var=self.truncate_to_tags,
+            text="Truncate at whole tags")
+        truncate_to_tags_chk.grid(row=4, column=0, sticky="w")
+
 
         #Steps per image
         steps_per_image_label = tk.Label(settings_group, text="Steps per image: ")
@@ -1390,10 +1384,9 @@ class generate_lora_subset_popup(object):
     def cancel(self, event = None):
         self.close()
 
-    #Save an info JSON for this subset to identify it as ours
-    def save_subset_info(self, path):
-        info_path = path / "LoRA_info.json"
-        info = {
+    #Settings of this subset as saved in its info JSON
+    def get_subset_info(self):
+        return {
             "lora_tag_helper_version": 1,
             "name": self.lora_name.get(),
             "include_lora_name": self.include_lora_name.get(),
@@ -1403,28 +1396,23 @@ class generate_lora_subset_popup(object):
             "include_feature": self.include_feature.get(),
             "include_other_features": self.include_other_features.get(),
             "include_automatic_tags": self.include_automatic_tags.get(),
-            "interrogate_automatic_tags": False,
+            "interrogate_automatic_tags": self.interrogate_automatic_tags.get(),
             "review_option": self.review_option.get(),
+            "truncate_to_tags": self.truncate_to_tags.get(),
             "steps_per_image": self.steps_per_image_entry.get(),
             "enable_filtering": self.enable_filtering.get(),
             "filter": self.filter.get(),
             "filter_rating": self.filter_rating.get(),
             "minimum_rating": self.minimum_rating.get()
         }
-        with open(info_path, "w") as f:
-            json.dump(info, f, indent=4)
-        utime(path)
+
+    #Save an info JSON for this subset to identify it as ours
+    def save_subset_info(self, path):
+        save_subset_info(path, self.get_subset_info())
 
     #Load info JSON from a subset
     def load_subset_info(self, path):
-        info_path = pathlib.Path(path) / "LoRA_info.json"
-        try:
-            with open(info_path) as f:
-                info = json.load(f)
-            return info
-        except:
-            print(traceback.format_exc())
-            return None
+        return load_subset_info(path)
         
 
     def find_newest_subset(self, lora_name):
@@ -1498,19 +1486,22 @@ class generate_lora_subset_popup(object):
                     self.interrogate_automatic_tags.set(info["interrogate_automatic_tags"])
                 except KeyError:
                     pass
+                try:
+                    self.truncate_to_tags.set(info["truncate_to_tags"])
+                except KeyError:
+                    pass
 
         except:
             print(traceback.format_exc())
         
 
     def generate(self, event = None):
+        if self.parent.dataset_still_loading(self.top):
+            return
+
         #Validate output path
         default_dir = pathlib.Path().absolute() / "lora_subsets"
-        output_path = pathlib.Path(self.output_path.get())
-        dataset_path = pathlib.Path(self.parent.path)        
-        if(output_path in dataset_path.parents 
-           or dataset_path in output_path.parents
-           or output_path == dataset_path):
+        if not is_valid_output_path(self.output_path.get(), self.parent.path):
             showerror(message=
                   "Output path must not be an ancestor of dataset path, "
                   "nor may it be within the dataset tree. This is to "
@@ -1566,6 +1557,7 @@ class generate_lora_subset_popup(object):
         
 
         self.save_subset_info(subset_path)
+        info = self.get_subset_info()
 
         popup = tk.Toplevel(self.top)
         tk.Label(popup, text="Processing subset images...").grid(row=0,column=0)
@@ -1584,164 +1576,15 @@ class generate_lora_subset_popup(object):
             current_image_index += 1
 
             #Load associated JSON and/or TXT as normal
-            self.parent.prompt = ""
-            item = self.parent.get_item_from_file(path)
-
-            #Get unique flat name for file
-            tgt_image = relpath(pathlib.Path(path), self.parent.path)
-            tgt_parent= relpath(pathlib.Path(tgt_image).parent)
-            tgt_basename = relpath(pathlib.Path(tgt_image).name)
-            tgt_image = tgt_basename
-            tgt_name = "".join(tgt_basename)[:-1]
-            tgt_ext = splitext(tgt_image)[-1]
-
-            if(tgt_name != item["title"] and item["title"]):
-                tgt_image = str(pathlib.Path(tgt_parent) / item["title"]) + tgt_ext
-
-            tgt_image = tgt_image.replace(sep, "_")
-            i = 2
-            while exists(tgt_image):
-                tgt_image = splitext(tgt_image)[0] + f"_{i}" + tgt_ext
-
-            tgt_prefix = splitext(tgt_image)[0]
-            
-
-            #Save .txt to subset folder
-            caption = ""
-            if self.include_lora_name.get():
-                caption += self.lora_name.get() + ", "
-            
-            if self.include_style.get() and item["style"]:
-                caption += item["style"]
-
-                if self.include_artist.get():
-                    caption += " by "
-                else:
-                    caption += ", "
-
-            if(self.include_artist.get()
-               and item["artist"]):
-                caption += item["artist"] + ", "
-            
-            if self.include_summary.get() and item["summary"]:
-                caption += item["summary"] + ", "
-            
-            if(self.include_feature.get()
-               and self.lora_name.get() in item["features"]):
-                feature = item["features"][self.lora_name.get()]
-                if feature == "":
-                    feature = self.lora_name.get()
-                caption += feature + ", "
-
-            if self.include_other_features.get():
-                for f in item["features"]:
-                    if f != self.lora_name.get() and item["features"][f]:
-                        feature = item["features"][f]
-                        if feature == "":
-                            feature = f
-                        caption += feature + ", "
-
-            try:
-                if self.interrogate_automatic_tags.get() and not item["automatic_tags"]:
-                    item["automatic_tags"] = interrogate_automatic_tags(path)
-            except:
-                print(traceback.format_exc())
-            
-            if self.include_automatic_tags.get() and item["automatic_tags"]:
-                caption += item["automatic_tags"]
-            
-            if caption.endswith(", "):
-                caption = caption[:-2]
-
-
-            components = caption.split(",")
-
-            unique_components_forward = []
-            for c in components:
-                found = False
-                for u_c in unique_components_forward:
-                    if c.strip().lower() in u_c.strip().lower():
-                        found = True
-                if not found:
-                    unique_components_forward.append(c.strip())
-
-            unique_components = []
-            for c in reversed(unique_components_forward):
-                found = False
-                for u_c in unique_components:
-                    if c.strip().lower() in u_c.strip().lower():
-                        found = True
-                if not found:
-                    unique_components.append(c.strip())
-
-            unique_caption = ", ".join(reversed(unique_components))
-
-            if self.enable_filtering.get():
-                filtered_components_or = re.split(",| OR ", self.filter.get())
-                match = False
-
-                for c in filtered_components_or:
-                    #Handle the AND operator
-                    match_and = True
-                    component_and = c.split(" AND ")
-                    for c_and in component_and:
-                        invert = False
-                        while c_and.strip().startswith("NOT "):
-                            c_and = c_and[4:]
-                            invert = not invert
-
-                        start_index = 1 if c_and in self.lora_name.get() and self.include_lora_name.get() else 0
-                        filter_caption = ",".join(caption.split(",")[start_index:])
-
-                        #Handle the NOT operator
-                        cur_match_and = c_and.strip().lower() in filter_caption.lower()
-                        if invert:
-                            cur_match_and = not cur_match_and
-                        match_and &= cur_match_and
-
-                    #Handle the OR operator or comma (treated equivalently)
-                    match |= match_and
-
-                #If this item doesn't match the filter, skip it.
-                if not match:
-                    continue
-
-            caption = unique_caption
-
-            if self.filter_rating.get() and item["rating"] < self.minimum_rating.get():
-                continue
-
-            if self.review_option.get() == 1: #Auto-truncate
-                caption = truncate_string_to_max_tokens(caption)
-            with open(str(subset_path / tgt_prefix) + ".txt", "w") as f:
-                f.write(" ".join(caption.split()))
-
-            #Crop image and output to subset folder
-            crop = item["crop"]
-            if crop != [0, 0, 1, 1]:            
-                with Image.open(path) as cropped_img:
-                    cropped_img = cropped_img.crop(
-                        (crop[0] * cropped_img.width,
-                         crop[1] * cropped_img.height,
-                         crop[2] * cropped_img.width, 
-                         crop[3] * cropped_img.height))
-                    cropped_img.save(subset_path / tgt_image)
-            else:
-                shutil.copy2(path, subset_path / tgt_image)
-
-            output_images.append(subset_path / tgt_image)
-
-            #Copy JSON to subset folder
-            json_file = "".join(splitext(path)[:-1]) + ".json"
-            target_json = str(subset_path / tgt_prefix) + ".json"
-            if isfile(json_file):
-                shutil.copy2(json_file, target_json)
-            else:
+            def get_item(path=path):
                 self.parent.prompt = ""
-                self.parent.write_item_to_file(
-                    self.parent.get_item_from_file(path),
-                    target_json
-                    )
+                return self.parent.get_item_from_file(path)
+
+            output_image = add_image_to_subset(
+                path, self.parent.path, info, subset_path, get_item,
+                copy_json=self.parent.metadata_store() is None)
+            if output_image is not None:
+                output_images.append(output_image)
 
 
         popup.destroy()
@@ -1778,6 +1621,346 @@ class generate_lora_subset_popup(object):
             print(traceback.format_exc())
         
 
+#Scrollable grid of thumbnails of the dataset. Only the cells in view have
+#canvas items, so the grid costs the same for 50 or 50k images. Thumbnails
+#come from the on-disk cache and missing ones are made in worker processes.
+#Badges show which images have a JSON, automatic tags and a crop.
+class thumbnail_browser_popup(object):
+    padding = 6
+    label_height = 16
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.thumbnails = thumbnail_cache(parent.path)
+        self.cell_width = self.thumbnails.size + 2 * self.padding
+        self.cell_height = (self.thumbnails.size + self.label_height
+                            + 2 * self.padding)
+        self.columns = 1
+        self.count = 0
+        self.current = None
+        self.cells = {}
+        self.photos = {}
+        self.placeholders = {}
+
+        self.create_ui()
+        self.poll()
+
+    def create_ui(self):
+        self.top = tk.Toplevel(self.parent)
+        self.top.title("Browse dataset")
+        self.top.geometry("760x600")
+        self.top.rowconfigure(0, weight=1)
+        self.top.columnconfigure(0, weight=1)
+        self.top.transient(self.parent)
+        self.top.wm_protocol("WM_DELETE_WINDOW", self.close)
+        self.top.bind("<Escape>", self.close)
+
+        self.canvas = tk.Canvas(self.top, background="gray20",
+                                highlightthickness=0)
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = tk.Scrollbar(self.top, orient=tk.VERTICAL,
+                                      command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+
+        self.canvas.bind("<Configure>", self.layout)
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", self.on_mousewheel)
+        self.canvas.bind("<Button-4>", lambda e: self.scroll(-1))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll(1))
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.render()
+
+    def scroll(self, rows):
+        self.canvas.yview_scroll(rows, "units")
+        self.render()
+
+    def on_mousewheel(self, event):
+        self.scroll(-1 if event.delta > 0 else 1)
+
+    #Recompute the number of columns when the window is resized. Cells only
+    #move if the number of columns changed.
+    def layout(self, e = None):
+        columns = max(self.canvas.winfo_width() // self.cell_width, 1)
+        if columns != self.columns:
+            self.columns = columns
+            for i in list(self.cells):
+                self.clear_cell(i)
+        self.update_scrollregion()
+        self.render()
+
+    #Make room for more images found by the loader. Images are only ever
+    #added at the end, so the cells already drawn stay where they are.
+    def update_scrollregion(self):
+        self.count = len(self.parent.image_files)
+        rows = (self.count + self.columns - 1) // self.columns
+        self.canvas.configure(
+            scrollregion=(0, 0, self.columns * self.cell_width,
+                          rows * self.cell_height),
+            yscrollincrement=self.cell_height // 4)
+
+    def visible_indices(self):
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first_row = max(int(top // self.cell_height), 0)
+        last_row = int(bottom // self.cell_height)
+        return range(first_row * self.columns,
+                     min((last_row + 1) * self.columns, self.count))
+
+    #Create the cells that came into view and drop the ones that left it
+    def render(self):
+        visible = self.visible_indices()
+        for i in list(self.cells):
+            if i not in visible:
+                self.clear_cell(i)
+
+        for i in visible:
+            if i not in self.cells:
+                self.draw_cell(i)
+        self.thumbnails.request(
+            [self.parent.image_files[i] for i in self.placeholders])
+
+    def clear_cell(self, i):
+        for item in self.cells.pop(i, []):
+            self.canvas.delete(item)
+        self.photos.pop(i, None)
+        self.placeholders.pop(i, None)
+
+    #Item values needed for the badges of an image
+    def badges(self, f):
+        try:
+            if self.parent.index is not None:
+                sidecars = self.parent.index.get_sidecars(f)
+            else:
+                sidecars = read_sidecars(f)
+            item = self.parent.get_defaults(f)
+            item.update(sidecars)
+            return [("J", "green", any(k != "automatic_tags" for k in sidecars)),
+                    ("T", "royalblue", bool(item["automatic_tags"])),
+                    ("C", "darkorange", item["crop"] != [0, 0, 1, 1])]
+        except:
+            print(traceback.format_exc())
+            return []
+
+    #Draw one cell, with a placeholder if its thumbnail isn't made yet
+    def draw_cell(self, i):
+        f = self.parent.image_files[i]
+        x = (i % self.columns) * self.cell_width
+        y = (i // self.columns) * self.cell_height
+        size = self.thumbnails.size
+        items = []
+
+        outline = "yellow" if i == self.parent.file_index else ""
+        items.append(self.canvas.create_rectangle(
+            x + 2, y + 2, x + self.cell_width - 2, y + self.cell_height - 2,
+            outline=outline, width=2))
+
+        thumbnail_file = self.thumbnails.get(f)
+        if thumbnail_file is not None:
+            item = self.create_thumbnail(i, thumbnail_file)
+            if item is not None:
+                items.append(item)
+        else:
+            self.placeholders[i] = self.canvas.create_text(
+                x + self.cell_width / 2, y + self.padding + size / 2,
+                text="...", fill="gray60")
+            items.append(self.placeholders[i])
+
+        items.append(self.canvas.create_text(
+            x + self.cell_width / 2,
+            y + self.padding + size + self.label_height / 2,
+            text=pathlib.Path(f).name[:20], fill="white"))
+
+        badge_x = x + self.padding
+        for text, color, shown in self.badges(f):
+            if shown:
+                items.append(self.canvas.create_rectangle(
+                    badge_x, y + self.padding, badge_x + 14, y + self.padding + 14,
+                    fill=color, outline=""))
+                items.append(self.canvas.create_text(
+                    badge_x + 7, y + self.padding + 7,
+                    text=text, fill="white"))
+            badge_x += 16
+
+        self.cells[i] = items
+
+    def create_thumbnail(self, i, thumbnail_file):
+        x = (i % self.columns) * self.cell_width
+        y = (i // self.columns) * self.cell_height
+        try:
+            self.photos[i] = ImageTk.PhotoImage(Image.open(thumbnail_file))
+            return self.canvas.create_image(
+                x + self.cell_width / 2, y + self.padding + self.thumbnails.size / 2,
+                image=self.photos[i], anchor="center")
+        except:
+            print(traceback.format_exc())
+            return None
+
+    #Swap a cell's placeholder for its thumbnail, leaving the rest as is
+    def show_thumbnail(self, i, thumbnail_file):
+        if i is None or i not in self.placeholders:
+            return
+        placeholder = self.placeholders.pop(i)
+        items = self.cells[i]
+        item = self.create_thumbnail(i, thumbnail_file)
+        if item is None:
+            items.remove(placeholder)
+        else:
+            #Keep the badges on top
+            self.canvas.tag_lower(item, placeholder)
+            items[items.index(placeholder)] = item
+        self.canvas.delete(placeholder)
+
+    def redraw_cell(self, i):
+        if i is not None and i in self.cells:
+            self.clear_cell(i)
+            self.draw_cell(i)
+
+    def on_click(self, event):
+        col = int(self.canvas.canvasx(event.x) // self.cell_width)
+        row = int(self.canvas.canvasy(event.y) // self.cell_height)
+        i = row * self.columns + col
+        if col >= self.columns or i >= self.count:
+            return
+        self.parent.save_unsaved_popup()
+        self.parent.file_index = i
+        self.parent.set_ui(i)
+
+    #Pick up finished thumbnails, newly found images and navigation in the
+    #main window
+    def poll(self):
+        try:
+            while True:
+                f, thumbnail_file = self.thumbnails.results.get_nowait()
+                self.show_thumbnail(
+                    self.parent.image_positions.find_file(f), thumbnail_file)
+        except queue.Empty:
+            pass
+
+        if len(self.parent.image_files) > self.count:
+            self.update_scrollregion()
+            self.render()
+        if self.parent.file_index != self.current:
+            previous, self.current = self.current, self.parent.file_index
+            self.redraw_cell(previous)
+            self.redraw_cell(self.current)
+
+        self.poll_job = self.top.after(100, self.poll)
+
+    def close(self, event = None):
+        try:
+            self.top.after_cancel(self.poll_job)
+        except:
+            print(traceback.format_exc())
+        self.thumbnails.close()
+        self.top.destroy()
+        self.parent.thumbnail_browser = None
+
+
+#Loads a dataset's image list, sidecars and known feature checklists on a
+#background thread. Tk may only be used from its own thread, so results are
+#posted to a queue that the application polls with after().
+class dataset_loader(object):
+    def __init__(self, parent, path):
+        self.parent = parent
+        self.path = path
+        self.index = parent.index
+        self.results = queue.Queue()
+        self.priority = queue.Queue()
+        self.stopped = threading.Event()
+        self.progress = "Loading dataset..."
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    #Build the checklist for this directory as soon as possible
+    def prioritize(self, directory):
+        self.priority.put(directory)
+
+    #Stop loading and wait for the thread to notice
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        try:
+            directories = self.find_images()
+            if directories is not None:
+                with sidecar_pool() as pool:
+                    self.index_directories(directories, pool)
+                self.index.invalidate()
+                self.index.save(prune=True)
+        except:
+            print(traceback.format_exc())
+        self.progress = ""
+        self.results.put(("done",))
+
+    #Post images in batches as they're found, grouped by directory
+    def find_images(self):
+        directories = {}
+        batch = []
+        last_post = time.time()
+        count = 0
+        for f in walk_images(self.path):
+            if self.stopped.is_set():
+                return None
+            count += 1
+            batch.append(f)
+            directory = relpath(f.parent, self.path)
+            directories.setdefault(directory, []).append(f)
+            if count == 1 or len(batch) >= 1000 or time.time() - last_post > 0.1:
+                self.results.put(("images", batch))
+                self.progress = f"Loading dataset: {count} images found..."
+                batch = []
+                last_post = time.time()
+        self.results.put(("images", batch))
+        return directories
+
+    #Read sidecars and build the known feature checklist of each directory,
+    #re-reading only what changed since the dataset was last opened.
+    def index_directories(self, directories, pool):
+        pending = deque(directories)
+        checklists = {}
+        while len(checklists) < len(directories):
+            if self.stopped.is_set():
+                return
+            self.progress = (f"Indexing folders: {len(checklists)}"
+                             f"/{len(directories)}...")
+
+            directory = None
+            while not self.priority.empty():
+                p = self.priority.get()
+                if p in directories and p not in checklists:
+                    directory = p
+                    break
+            while directory is None:
+                p = pending.popleft()
+                if p not in checklists:
+                    directory = p
+
+            #Parents first, their features are left out of the child's list
+            ancestors = [str(p) for p in reversed(pathlib.Path(directory).parents)]
+            for d in ancestors + [directory]:
+                if d in directories and d not in checklists:
+                    self.index_directory(d, directories[d], pool, checklists)
+
+    def index_directory(self, directory, files, pool, checklists):
+        self.index.get_prompts_many(files, pool)
+        signature = self.index.directory_signature(directory, files, pool)
+        known_features = self.index.get_known_features(directory, signature)
+        if known_features is None:
+            known_features = {}
+            for item in self.parent.get_items_from_files(files, pool):
+                self.parent.update_known_features(known_features, item)
+            self.index.set_known_features(directory, signature, known_features)
+
+        checklists[directory] = self.parent.build_known_feature_checklist(
+            directory, known_features, checklists)
+        self.results.put(("checklist", directory, checklists[directory]))
+
+
 # the given message with a bouncing progress bar will appear for as long as func is running, returns same as if func was run normally
 # a pb_length of None will result in the progress bar filling the window whose width is set by the length of msg
 # Ex:  run_func_with_loading_popup(lambda: task('joe'), photo_img)  
@@ -1876,8 +2059,14 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.crop_top_area = None
         self.crop_right_area = None
         self.crop_bottom_area = None
+        self.crop_tile = None
+        self.crop_area_photos = {}
+        self.crop_area_sizes = {}
         self.already_initialized = False
         self.image_files = []
+        self.image_positions = image_positions()
+        self.image_path = None
+        self.image_service = image_service.image_service()
         self.file_index = 0
         self.features = []
         self.l_pct = 0
@@ -1889,8 +2078,14 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.icon_image = Image.open("icon.png")
         self.ctrl_pressed = False
         self.prompt = ""
+        self.index = None
+        self.defaults_resolver = None
+        self.loader = None
+        self.thumbnail_browser = None
 
         self.feature_checklist = []
+        self.known_feature_checklists = {}
+        self.deleted_features = {}
         self.geometry("1200x600")
 
         self.create_ui()
@@ -1901,6 +2096,7 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.listener.start()
         self.update()
         self.after(1000, self.import_reqs)
+        self.after(1000, self.poll_statusbar)
 
     def import_reqs(self, event = None):
         try:
@@ -1984,6 +2180,12 @@ class lora_tag_helper(TkinterDnD.Tk):
                               accelerator="Ctrl+G")
         self.bind("<Control-g>", self.go_to_image)
 
+        file_menu.add_command(label="Browse thumbnails...", 
+                              command=self.browse_thumbnails, 
+                              underline=0, 
+                              accelerator="Ctrl+Shift+B")
+        self.bind("<Control-B>", self.browse_thumbnails)
+
         file_menu.add_command(label="Reset this image to defaults...", 
                               command=self.reset, 
                               underline=0, 
@@ -2010,6 +2212,22 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.bind("<Control-T>", self.update_all_automatic_tags)
 
 
+        file_menu.add_separator()
+
+        file_menu.add_command(label="Keep metadata in a single file...", 
+                              command=self.create_metadata_store, 
+                              underline=0)
+
+        file_menu.add_command(label="Move metadata back to sidecar files...", 
+                              command=self.remove_metadata_store, 
+                              underline=0)
+
+        file_menu.add_command(label="Image memory budget...", 
+                              command=self.set_memory_budget, 
+                              underline=6)
+
+        file_menu.add_separator()
+
         file_menu.add_command(label="Exit", 
                               command=self.quit, 
                               underline=1, 
@@ -2040,7 +2258,11 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.sizer_frame.rowconfigure(0, weight=1)
         self.sizer_frame.columnconfigure(0, weight=1)
 
-        self.sizer_frame.bind("<Configure>", self.image_resizer)
+        self.display = None
+        self.photo = None
+        self.photo_display = None
+        self.resize_job = None
+        self.sizer_frame.bind("<Configure>", self.schedule_image_resize)
 
         self.x = self.y = 0
         self.canvas = tk.Canvas(self.sizer_frame, cursor="cross")
@@ -2103,56 +2325,66 @@ class lora_tag_helper(TkinterDnD.Tk):
         return (int(x_pct * self.image_width + x_offset),
                 int(y_pct * self.image_height + y_offset))
 
+    #Shade the parts of the image outside the crop. The four shaded areas are
+    #canvas images, created once and then only moved, and refilled with a
+    #semi-transparent tile when their size changes. Stipples aren't drawn
+    #on macOS.
     def generate_crop_rectangle(self):
         f_w = self.image_frame.winfo_width() - 4
         f_h = self.image_frame.winfo_height() - 4
         x_offset = (f_w - self.image_width) / 2
         y_offset = (f_h - self.image_height) / 2
-
-        try:
-            if self.crop_left_area:
-                self.canvas.delete(self.crop_left_area)
-            if self.crop_top_area:
-                self.canvas.delete(self.crop_top_area)
-            if self.crop_right_area:
-                self.canvas.delete(self.crop_right_area)
-            if self.crop_bottom_area:
-                self.canvas.delete(self.crop_bottom_area)
-        except:
-            print(traceback.format_exc())
+        x_end = x_offset + self.image_width
+        y_end = y_offset + self.image_height
 
         l, t = self.pct_to_coord(self.l_pct, self.t_pct)
         r, b = self.pct_to_coord(self.r_pct, self.b_pct)
 
-        
-        w = int(l - x_offset)
-        h = int(f_h - 2 * y_offset)
-        fill = self.canvas.winfo_rgb("red") + (int((0.5 if w > 1 else 0) * 255),)
-        image = Image.new('RGBA', (w, h), fill)
-        self.crop_left_image = ImageTk.PhotoImage(image)
-        self.crop_left_area = self.canvas.create_image(x_offset, y_offset, image=self.crop_left_image, anchor="nw")
-
-        w = int(r - l)
-        h = int(t - y_offset)
-        fill = self.canvas.winfo_rgb("red") + (int((0.5 if h > 1 else 0) * 255),)
-        image = Image.new('RGBA', (w, h), fill)
-        self.crop_top_image = ImageTk.PhotoImage(image)
-        self.crop_top_area = self.canvas.create_image(l, y_offset, image=self.crop_top_image, anchor="nw")
-
-        w = int(f_w - r - x_offset)
-        h = int(f_h - 2 * y_offset)
-        fill = self.canvas.winfo_rgb("red") + (int((0.5 if w > 1 else 0) * 255),)
-        image = Image.new('RGBA', (w, h), fill)
-        self.crop_right_image = ImageTk.PhotoImage(image)
-        self.crop_right_area = self.canvas.create_image(r, y_offset, image=self.crop_right_image, anchor="nw")
-
-        w = int(r - l)
-        h = int(f_h - b - y_offset)
-        fill = self.canvas.winfo_rgb("red") + (int((0.5 if h > 1 else 0) * 255),)
-        image = Image.new('RGBA', (w, h), fill)
-        self.crop_bottom_image = ImageTk.PhotoImage(image)
-        self.crop_bottom_area = self.canvas.create_image(l, b, image=self.crop_bottom_image, anchor="nw")
+        if self.crop_left_area is None:
+            self.crop_tile = ImageTk.PhotoImage(
+                Image.new("RGBA", (CROP_TILE_SIZE, CROP_TILE_SIZE), CROP_SHADE))
+            areas = []
+            for _ in range(4):
+                photo = tk.PhotoImage(master=self.canvas)
+                area = self.canvas.create_image(0, 0, anchor="nw", image=photo)
+                self.crop_area_photos[area] = photo
+                areas.append(area)
+            self.crop_left_area, self.crop_top_area, self.crop_right_area, \
+                self.crop_bottom_area = areas
+
+        self.place_crop_area(self.crop_left_area, x_offset, y_offset, l, y_end)
+        self.place_crop_area(self.crop_top_area, l, y_offset, r, t)
+        self.place_crop_area(self.crop_right_area, r, y_offset, x_end, y_end)
+        self.place_crop_area(self.crop_bottom_area, l, b, r, y_end)
+
+        for area in self.crop_areas():
+            self.canvas.tag_raise(area)
+
+    def place_crop_area(self, area, x1, y1, x2, y2):
+        w = max(int(round(x2 - x1)), 0)
+        h = max(int(round(y2 - y1)), 0)
+        self.canvas.coords(area, x1, y1)
+        if w == 0 or h == 0:
+            self.canvas.itemconfigure(area, state="hidden")
+            return
+
+        if self.crop_area_sizes.get(area) != (w, h):
+            photo = self.crop_area_photos[area]
+            photo.blank()
+            photo.configure(width=w, height=h)
+            #Tk repeats the tile to fill the area
+            photo.tk.call(photo, "copy", self.crop_tile, "-to", 0, 0, w, h)
+            self.crop_area_sizes[area] = (w, h)
+        self.canvas.itemconfigure(area, state="normal")
 
+    def crop_areas(self):
+        return [area for area in [self.crop_left_area, self.crop_top_area,
+                                  self.crop_right_area, self.crop_bottom_area]
+                if area]
+
+    def hide_crop_rectangle(self):
+        for area in self.crop_areas():
+            self.canvas.itemconfigure(area, state="hidden")
 
     def on_button_release(self, event):
         coord1 = self.pct_to_coord(self.l_pct, self.t_pct)
@@ -2163,10 +2395,7 @@ class lora_tag_helper(TkinterDnD.Tk):
             self.t_pct = 0
             self.r_pct = 1
             self.b_pct = 1
-            self.canvas.delete(self.crop_left_area)
-            self.canvas.delete(self.crop_top_area)
-            self.canvas.delete(self.crop_right_area)
-            self.canvas.delete(self.crop_bottom_area)
+            self.hide_crop_rectangle()
 
     #Create the initial frame display
     def create_initial_frame(self):
@@ -2532,6 +2761,10 @@ class lora_tag_helper(TkinterDnD.Tk):
                 for p in self.known_feature_checklists:
                     if p in parents:
                         self.known_feature_checklists[p] = [x for x in self.known_feature_checklists[p] if not x[0].startswith(iid)]
+                #Checklists still being built drop it when they arrive
+                if self.loader is not None:
+                    for p in parents:
+                        self.deleted_features.setdefault(p, set()).add(iid)
                           
         except:
             print(traceback.format_exc())
@@ -2598,6 +2831,8 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.summary_textbox.delete("1.0", "end")
         self.automatic_tags_textbox.delete("1.0", "end")
         self.image = self.icon_image
+        self.image_path = None
+        self.display = None
         self.framed_image = ImageTk.PhotoImage(self.image)
         self.canvas.delete(self.image_handle)
 
@@ -2622,6 +2857,7 @@ class lora_tag_helper(TkinterDnD.Tk):
 
         f = self.image_files[index]
         self.load_image(f)
+        self.prefetch_images(index)
 
         if item is None:
             item = self.get_item_from_file(self.image_files[index])
@@ -2706,80 +2942,146 @@ class lora_tag_helper(TkinterDnD.Tk):
             self.next_file_btn["state"] = "disabled"
 
         
-        self.statusbar_text.set(f"Image {1 + self.file_index}/{len(self.image_files)}: "
-                                f"{relpath(pathlib.Path(self.image_files[self.file_index]), self.path)}")
+        self.update_statusbar()
+
+        #Ask the loader for this image's checklists first if not yet built
+        if self.loader is not None:
+            for p in reversed(self.current_directories()):
+                if p not in self.known_feature_checklists:
+                    self.loader.prioritize(p)
 
         self.update_idletasks()
         
        
 
-    #Gather known feature set
-    def update_known_features(self, file, item):
-        relative_path = pathlib.Path(relpath(pathlib.Path(file), self.path))
-        parents = [str(p) for p in relative_path.parents]
-        for p in parents:
-            if p not in self.known_features:
-                self.known_features[p] = {}
-
-        p = parents[0]
-
-        combined_features = {}
-        if p in self.known_features:
-            combined_features = self.known_features[p]
-
+    #Gather known feature set for the images of one directory. Each feature
+    #maps to an ordered set (a dict with no values) of its components.
+    def update_known_features(self, combined_features, item):
         if "features" in item:
             for feature in item["features"]:
-                components = item["features"][feature].split(",")
-                if feature not in combined_features:
-                    combined_features[feature] = ""
-                combined_components = combined_features[feature].split(",")
-                    
-                for c in components:
+                combined_components = combined_features.setdefault(feature, {})
+                for c in item["features"][feature].split(","):
                     c = c.strip()
-                    if c not in combined_components:
-                        combined_features[feature] += ", " + c                            
+                    if c != '':
+                        combined_components[c] = None
+
+    #Build the checklist for one directory, skipping items that a parent's
+    #already-built checklist provides.
+    def build_known_feature_checklist(self, path, known_features, checklists):
+        inherited = set()
+        for p in pathlib.Path(path).parents:
+            inherited.update(checklists.get(str(p), ()))
+
+        known_checklist = set()
+        for name in known_features:
+            if name != '':
+                known_checklist.add((name, False))
+                for c in known_features[name]:
+                    if c != name:
+                        for c_split in self.split_component(c):
+                            known_checklist.add(
+                                (name + treeview_separator + c_split, False))
+        return sorted(known_checklist - inherited)
+
+    #Add a checklist from the loader without undoing edits made since it
+    #started: features deleted here stay deleted, saved ones are kept.
+    def merge_known_feature_checklist(self, directory, checklist):
+        deleted = self.deleted_features.get(directory, ())
+        checklist = [x for x in checklist
+                     if not any(x[0].startswith(iid) for iid in deleted)]
+        current = self.known_feature_checklists.get(directory)
+        if current is not None:
+            present = set(current)
+            checklist = current + [x for x in checklist if x not in present]
+        self.known_feature_checklists[directory] = checklist
+
+    #Handle results posted by the background dataset loader
+    def poll_dataset_loader(self, loader):
+        if loader is None or loader is not self.loader:
+            return
 
-        self.known_features.update({p: combined_features})
-                    
+        done = False
+        try:
+            while True:
+                message = loader.results.get_nowait()
+                if message[0] == "images":
+                    first = len(self.image_files) == 0
+                    self.image_positions.add(message[1], len(self.image_files))
+                    self.image_files.extend(message[1])
+                    if first and len(self.image_files) > 0:
+                        self.file_index = 0
+                        self.set_ui(self.file_index)
+                        self.hide_initial_frame()
+                    elif self.file_index < len(self.image_files) - 1:
+                        self.next_file_btn["state"] = "normal"
+                elif message[0] == "checklist":
+                    _, directory, checklist = message
+                    self.merge_known_feature_checklist(directory, checklist)
+                    if(len(self.image_files) > 0
+                       and directory in self.current_directories()):
+                        self.build_checklist_from_features()
+                elif message[0] == "done":
+                    done = True
+        except queue.Empty:
+            pass
 
-    def build_known_feature_checklists(self):
-        self.known_feature_checklists = {}
-        for path in self.known_features:
-            known_checklist = []
-            p = str(path)
-            for name in self.known_features[p]:
-                if name != '':
-                    desc = self.known_features[p][name]
-                    new_item = (name, False)
-
-                    found = False
-                    for parent in pathlib.Path(path).parents:
-                        parent = str(parent)
-                        if parent not in self.known_feature_checklists:
-                            self.known_feature_checklists[parent] = {}
-                        if new_item in self.known_feature_checklists[parent]:
-                            found = True
-
-                    if not found and new_item not in known_checklist:
-                        known_checklist.append(new_item)
-                    components = desc.split(",")
-                    for c in components:
-                        c = c.strip()
-                        if c != '' and c != name:
-                            for c_split in self.split_component(c):
-                                new_item = (name + treeview_separator + c_split, False)
-                                found = False
-                                for parent in pathlib.Path(path).parents:
-                                    if new_item in self.known_feature_checklists[str(parent)]:
-                                        found = True
-                                if not found and new_item not in known_checklist:
-                                    known_checklist.append(new_item)
-            known_checklist.sort()
-            self.known_feature_checklists[path] = known_checklist
-
-        self.known_features = {}
+        if not done:
+            self.update_statusbar()
+            self.after(50, self.poll_dataset_loader, loader)
+            return
 
+        self.loader = None
+        self.update_statusbar()
+        if len(self.image_files) == 0:
+            showwarning(parent=self,
+                        title="Empty Dataset",
+                        message="No supported images found in dataset")
+            self.show_initial_frame()
 
+    #Directory of the current image, relative to the dataset, and its parents
+    def current_directories(self):
+        path = relpath(pathlib.Path(self.image_files[self.file_index]).absolute().parent, self.path)
+        parents = [str(p).strip() for p in pathlib.Path(path).parents]
+        parents.insert(0, str(path).strip())
+        return parents
+
+    def update_statusbar(self):
+        text = ""
+        if len(self.image_files) > 0 and self.file_index < len(self.image_files):
+            text = (f"Image {1 + self.file_index}/{len(self.image_files)}: "
+                    f"{relpath(pathlib.Path(self.image_files[self.file_index]), self.path)}")
+        if self.loader is not None and self.loader.progress:
+            text += f"    [{self.loader.progress}]"
+        if len(self.image_files) > 0:
+            used = self.image_service.memory_used() / 2**20
+            budget = self.image_service.cache.max_bytes / 2**20
+            stats = self.image_service.stats()
+            text += (f"    Image memory: {used:.0f}/{budget:.0f} MB, "
+                     f"cache hits: {stats['hit_rate']:.0%}, "
+                     f"decode: {stats['decode_ms']:.0f} ms avg")
+        self.statusbar_text.set(text)
+
+    #Keep the image memory in the status bar current while images are
+    #prefetched in the background
+    def poll_statusbar(self):
+        if self.loader is None:
+            self.update_statusbar()
+        self.after(1000, self.poll_statusbar)
+
+    #Ask for the memory budget for decoded images
+    def set_memory_budget(self, event = None):
+        budget = tkinter.simpledialog.askinteger(
+            "Image memory budget",
+            "Memory for decoded images, in MB. Images that wouldn't fit in "
+            f"a {image_service.proxy_share}th of it are shown from a "
+            "downsampled copy.",
+            parent=self,
+            initialvalue=self.image_service.cache.max_bytes // 2**20,
+            minvalue=16)
+        if budget:
+            image_service.memory_budget = budget * 2**20
+            self.image_service.set_memory_budget(image_service.memory_budget)
+            self.update_statusbar()
 
     #Create open dataset action
     def open_dataset(self, event = None, directory = None):
@@ -2789,13 +3091,13 @@ class lora_tag_helper(TkinterDnD.Tk):
             if not answer:
                 return
             
-        self.known_features = {}
         self.clear_ui()
         self.show_initial_frame()
 
         #Clear the UI and associated variables
         self.file_index = 0
         self.image_files = []
+        self.image_positions = image_positions()
 
         #Popup folder selection dialog
         if directory is None:
@@ -2812,42 +3114,114 @@ class lora_tag_helper(TkinterDnD.Tk):
         else:
             self.path = directory                    
 
-        #Get supported extensions
-        exts = Image.registered_extensions()
-        supported_exts = {ex for ex, f in exts.items() if f in Image.OPEN}
+        if self.loader is not None:
+            self.loader.stop()
+            self.loader = None
+        if self.thumbnail_browser is not None:
+            self.thumbnail_browser.close()
+        if self.index is not None:
+            self.index.close()
+        self.index = dataset_index(self.path)
+        self.defaults_resolver = defaults_resolver(self.path)
+        self.known_feature_checklists = {}
+        self.deleted_features = {}
+        self.image_positions = image_positions(self.path)
 
-        #Get list of filenames matching those extensions
-        files = [pathlib.Path(f).absolute()
-                 for f in pathlib.Path(self.path).rglob("*")
-                  if isfile(join(self.path, f))]
-        
-        self.image_files = [
-            f for f in files if splitext(f)[1] in supported_exts]  
+        #Enumerate images and their metadata in the background. The first
+        #image is shown as soon as it's found.
+        self.loader = dataset_loader(self, self.path)
+        self.poll_dataset_loader(self.loader)
 
-        self.image_files.sort()
 
-        #Populate JSONs
-        for path in self.image_files:
-            json_file = splitext(path)[0] + ".json"
-            item = self.get_item_from_file(path)
-            self.update_known_features(path, item)
-            #self.write_item_to_file(item, json_file)
-        self.build_known_feature_checklists()
+    #Show the thumbnail grid of the dataset
+    def browse_thumbnails(self, event = None):
+        if len(self.image_files) == 0:
+            return
+        if self.thumbnail_browser is not None:
+            self.thumbnail_browser.top.lift()
+            return
+        self.thumbnail_browser = thumbnail_browser_popup(self)
 
-        #Point UI to beginning of queue
-        if(len(self.image_files) > 0):
-            self.file_index = 0
-            self.set_ui(self.file_index)
-            self.hide_initial_frame()
-        else:
-            showwarning(parent=self,
-                        title="Empty Dataset",
-                        message="No supported images found in dataset")
-            self.show_initial_frame()
-        
+    #Move the .txt and .json of every image into one metadata store file
+    def create_metadata_store(self, event = None):
+        if self.index is None:
+            return
+        if self.metadata_store() is not None:
+            showinfo(parent=self,
+                     title="Already using a metadata file",
+                     message="This dataset already keeps its metadata in "
+                             f"{dataset.STORE_FILENAME}.")
+            return
+
+        self.save_unsaved_popup()
+        if not askyesno(parent=self,
+                        title="Keep metadata in a single file?",
+                        message="Copy the .txt and .json files of all images "
+                                "into a single file in the dataset folder? "
+                                "From then on, the .txt and .json files of "
+                                "those images are no longer used."):
+            return
+
+        image_files = list(walk_images(self.path))
+        run_func_with_loading_popup(
+            self,
+            lambda: self.index.create_store(image_files),
+            "Moving metadata into a single file...",
+            "Moving metadata into a single file...")
+
+        if askyesno(parent=self,
+                    title="Delete sidecar files?",
+                    message="Delete the .txt and .json files that were "
+                            "copied? They can be recreated with \"Move "
+                            "metadata back to sidecar files\"."):
+            for f in image_files:
+                if self.index.in_store(self.index.key(f)):
+                    for ext in [".txt", ".json"]:
+                        try:
+                            remove(splitext(f)[0] + ext)
+                        except FileNotFoundError:
+                            pass
+                        except:
+                            print(traceback.format_exc())
+
+        self.open_dataset(directory=self.path)
+
+    #Write the metadata store back out as sidecars and delete it
+    def remove_metadata_store(self, event = None):
+        if self.metadata_store() is None:
+            return
+
+        self.save_unsaved_popup()
+        if not askyesno(parent=self,
+                        title="Move metadata to sidecar files?",
+                        message="Write the metadata of all images back to "
+                                ".txt and .json files next to each image? "
+                                "Existing files will be overwritten."):
+            return
+
+        run_func_with_loading_popup(
+            self,
+            lambda: self.index.remove_store(),
+            "Moving metadata to sidecar files...",
+            "Moving metadata to sidecar files...")
+
+        self.open_dataset(directory=self.path)
+
+    #Warn and return True if the dataset is still being listed, so actions
+    #over every image don't silently miss the ones not found yet
+    def dataset_still_loading(self, parent = None):
+        if self.loader is None:
+            return False
+        showwarning(parent=parent or self,
+                    title="Still loading",
+                    message="The dataset is still loading. Try again once "
+                            "all images have been found.")
+        return True
 
     #Create open dataset action
     def generate_lora_subset(self, event = None):
+        if self.dataset_still_loading():
+            return
         if len(self.image_files) > 0:
             self.save_unsaved_popup()
             #Pop up dialog to gather information and perform generation
@@ -2857,56 +3231,73 @@ class lora_tag_helper(TkinterDnD.Tk):
 
     def load_image(self, f):
         try:
-            self.image = Image.open(f)
+            self.image_path = f
+            if self.index is not None:
+                self.prompt = self.index.get_prompt(f)
+            else:
+                self.prompt = read_prompt(f)
             self.image_resizer()
+        except:
+            self.image_path = None
+            print(traceback.format_exc())
 
-            prompt = ""
+    #Size available to show the image in
+    def image_box(self):
+        return (max(self.image_frame.winfo_width() - 4, 1),
+                max(self.image_frame.winfo_height() - 4, 1))
+
+    #Decode the next and previous images in the background
+    def prefetch_images(self, index):
+        n = image_service.prefetch_count
+        ahead = self.image_files[index + 1:index + 1 + n]
+        behind = self.image_files[max(index - n, 0):index][::-1]
+        self.image_service.prefetch(ahead + behind, self.image_box())
+
+    #Draw a quick preview while the window is resized, and the proper image
+    #once it hasn't been resized for a moment
+    def schedule_image_resize(self, e = None):
+        if self.resize_job is not None:
+            self.after_cancel(self.resize_job)
+        self.resize_job = self.after(image_service.resize_delay,
+                                     self.image_resizer)
+        if self.display is not None:
             try:
-                self.image.load()  # Needed only for .png EXIF data
-                prompt = " ".join(self.image.info['parameters'].split("Negative prompt: ")[0].split())
-                prompt = re.sub(r"<.*>", "", prompt).strip().strip(",").strip()
+                self.show_image(self.display.preview(self.image_box()),
+                                preview=True)
             except:
-                pass
-
-            self.prompt = prompt
-        except:
-            print(traceback.format_exc())
+                print(traceback.format_exc())
 
+    #PhotoImage of a display image, made on the Tk thread and kept by this
+    #window only while it's the image shown
+    def display_photo(self, display):
+        if display is not self.photo_display:
+            self.photo = ImageTk.PhotoImage(display.image)
+            self.photo_display = display
+        return self.photo
 
     #Resize image to fit resized window
     def image_resizer(self, e = None):
-        try:
-            l, t = self.pct_to_coord(self.l_pct, self.t_pct)
-            r, b = self.pct_to_coord(self.r_pct, self.b_pct)
-        except:
-            print(traceback.format_exc())
-
-        tgt_width = self.image_frame.winfo_width() - 4
-        tgt_height = self.image_frame.winfo_height() - 4
-
-        if tgt_width < 1:
-            tgt_width = 1
-        if tgt_height < 1:
-            tgt_height = 1
-
-        new_width = int(tgt_height * self.image.width / self.image.height)
-        new_height = int(tgt_width * self.image.height / self.image.width)
-
-        if new_width < 1:
-            new_width = 1
-        if new_height < 1:
-            new_height = 1
-
-        if new_width <= tgt_width:
-            self.image_width = new_width
-            self.image_height = tgt_height
-        else:
-            self.image_width = tgt_width
-            self.image_height = new_height
-        resized_image = self.image.resize(
-            (self.image_width, self.image_height), 
-            Image.LANCZOS)
-        self.framed_image = ImageTk.PhotoImage(resized_image)
+        self.resize_job = None
+        box = self.image_box()
+        if self.image_path is not None:
+            try:
+                self.display = self.image_service.get(self.image_path, box)
+                self.show_image(self.display.image,
+                                photo=self.display_photo(self.display))
+                return
+            except:
+                print(traceback.format_exc())
+        self.show_image(self.image.resize(
+            fit_size(self.image.width, self.image.height, *box),
+            Image.LANCZOS))
+
+    #Put a resized image on the canvas. The crop overlay is hidden while
+    #previewing and redrawn with the final image.
+    def show_image(self, resized_image, preview = False, photo = None):
+        self.image_width, self.image_height = resized_image.size
+        if photo is None:
+            photo = ImageTk.PhotoImage(resized_image)
+        self.framed_image = photo
         #self.image_label.configure(image=self.framed_image)
         center_x = self.sizer_frame.winfo_width() / 2
         center_y = self.sizer_frame.winfo_height() / 2
@@ -2919,7 +3310,10 @@ class lora_tag_helper(TkinterDnD.Tk):
         self.image_handle = self.canvas.create_image(center_x, center_y, anchor="center",image=self.framed_image)
 
         try:
-            self.generate_crop_rectangle()
+            if preview:
+                self.hide_crop_rectangle()
+            else:
+                self.generate_crop_rectangle()
         except:
             print(traceback.format_exc())
 
@@ -3007,13 +3401,13 @@ class lora_tag_helper(TkinterDnD.Tk):
         return [c]
 
     def build_checklist_from_features(self):
-        path = relpath(pathlib.Path(self.image_files[self.file_index]).absolute().parent, self.path)
-        parents = [str(p).strip() for p in pathlib.Path(path).parents]
-        parents.insert(0, str(path).strip())
+        parents = self.current_directories()
         self.feature_checklist = []
+        found = set()
         for p in parents:
-            for x in self.known_feature_checklists[str(p)]:
-                if x not in self.feature_checklist:
+            for x in self.known_feature_checklists.get(str(p), []):
+                if x not in found:
+                    found.add(x)
                     self.feature_checklist.append(x)
 
         for row in self.features:
@@ -3153,79 +3547,71 @@ class lora_tag_helper(TkinterDnD.Tk):
 
         return item
     
-    def get_defaults(self, path = None):
+    def get_defaults(self, path = None, prompt = None):
+        #Explicit paths may come from the background loader before the Tk
+        #thread has received any images, so only check for them otherwise.
+        no_dataset = path is None and len(self.image_files) == 0
         if path is None:
             if len(self.image_files) == 0:
                 path = "./dataset/default.png"
             else:
                 path = self.image_files[self.file_index]
                 
-        defaults = {"lora_tag_helper_version": 1,
-                    "title":splitext(pathlib.Path(path).name)[0],
-                    "artist": "unknown",
-                    "style": "photo",
-                    "rating": 0,
-                    "summary": self.prompt,
-                    "features": {},
-                    "crop": [0, 0, 1, 1],
-                    "automatic_tags": ""}
+        defaults = item_defaults(path, self.prompt if prompt is None else prompt)
 
-        if len(self.image_files) == 0:
+        if no_dataset or self.defaults_resolver is None:
             return defaults
-        
-        path = pathlib.Path(path)        
-        paths = [p for p in reversed(pathlib.Path(path).parents) if p not in pathlib.Path(self.path).parents]
 
-        for p in paths:
-            json_file = p / "defaults.json"
-            if isfile(json_file):
-                try:
-                    with open(json_file) as f:
-                        features = {}
-                        if "features" in defaults:
-                            features.update(defaults["features"])
-                        defaults.update(json.load(f))
-                        if "features" in defaults:
-                            features.update(defaults["features"])
-                        defaults["features"] = features
-                except:
-                    pass
+        #Cascade defaults.json values from the dataset root down to the file
+        defaults.update(self.defaults_resolver.resolve(pathlib.Path(path).parent))
         return defaults
     
     def get_item_from_file(self, path):
         #Read filename into title
         item = self.get_defaults(path)
 
-        #If .txt available, read into automated caption
-        txt_file = splitext(path)[0] + ".txt"
-        try:
-            with open(txt_file) as f:
-                item["automatic_tags"] = ' '.join(f.read().split())
-        except (FileNotFoundError) as error:
-            pass
+        #Overlay .txt and .json sidecars
+        item.update(self.get_sidecars(path))
 
-        #If available, parse JSON into fields
-        json_file = splitext(path)[0] + ".json"
-        try:
-            with open(json_file) as f:
-                json_item = json.load(f)
-                item.update(json_item)
-        except FileNotFoundError:
-            pass
+        dataset.check_item_version(item)
+        return item
 
-        try:
-            if item["lora_tag_helper_version"] > 1:
-                print("Warning: file generated by newer version of lora_tag_helper")
-        except:
-            print(traceback.format_exc())
+    #Sidecar values of a file, from the index if they're unchanged. Also
+    #called from interrogation threads.
+    def get_sidecars(self, path):
+        if self.index is not None:
+            self.index.invalidate(path)
+            return self.index.get_sidecars(path)
+        return read_sidecars(path)
+
+    #Read the items for many files, parsing their sidecars concurrently.
+    #Sidecar signatures cached by the index are trusted, so this is meant
+    #for bulk scans rather than re-reading the current image.
+    def get_items_from_files(self, paths, pool = None):
+        if self.index is not None:
+            all_sidecars = self.index.get_sidecars_many(paths, pool)
+            prompts = self.index.get_prompts_many(paths, pool)
+        else:
+            all_sidecars = read_sidecars_many(paths, pool)
+            prompts = [None] * len(paths)
 
-        return item
+        items = []
+        for path, sidecars, prompt in zip(paths, all_sidecars, prompts):
+            item = self.get_defaults(path, prompt)
+            item.update(sidecars)
+            dataset.check_item_version(item)
+            items.append(item)
+        return items
 
 
+    def metadata_store(self):
+        if self.index is None:
+            return None
+        return self.index.store
+
     def write_item_to_file(self, item, json_file):
         try:
-            with open(json_file, "w") as f:
-                json.dump(item, f, indent=4)
+            dataset.write_item_to_file(item, json_file, self.metadata_store())
         except:
             showerror(parent=self,
                       title="Couldn't save JSON",
@@ -3253,25 +3639,28 @@ class lora_tag_helper(TkinterDnD.Tk):
 
     #Update automatic tags in JSON for image file
     def update_automatic_tags(self, path, popup=False):
-        if not interrogator_ready:
+        if not interrogation.interrogator_ready:
             showwarning(parent=self,
                         title="Not ready",
                         message="The interrogator is not yet ready.")
             return        
-        json_file = splitext(path)[0] + ".json"
-        item = self.get_item_from_file(json_file)
 
         if popup:
-            item["automatic_tags"] = run_func_with_loading_popup(
+            automatic_tags = run_func_with_loading_popup(
                 self,
-                lambda: interrogate_automatic_tags(path), 
+                lambda: interrogate_automatic_tags(path, self.get_sidecars), 
                 "Interrogating Image...", 
                 "Interrogating Image...")            
         else:
-            item["automatic_tags"] = interrogate_automatic_tags(path)
+            automatic_tags = interrogate_automatic_tags(path, self.get_sidecars)
 
-        if "automatic_tags" not in item or not item["automatic_tags"]:
-            item["automatic_tags"] = ""
+        self.write_automatic_tags(path, automatic_tags)
+
+    #Store automatic tags in an image's JSON
+    def write_automatic_tags(self, path, automatic_tags):
+        json_file = splitext(path)[0] + ".json"
+        item = self.get_item_from_file(json_file)
+        item["automatic_tags"] = automatic_tags or ""
 
         defaults = self.get_defaults(json_file)
         trimmed_item = {x:item[x] for x in item if x in defaults and item[x] != defaults[x]}
@@ -3280,33 +3669,81 @@ class lora_tag_helper(TkinterDnD.Tk):
 
     #Update automatic tags in all JSON files
     def update_all_automatic_tags(self, event = None):
-        if not interrogator_ready:
+        if not interrogation.interrogator_ready:
             showwarning(parent=self,
                         title="Not ready",
                         message="The interrogator is not yet ready.")
             return        
+        if self.dataset_still_loading():
+            return
 
         self.save_unsaved_popup()
         popup = tk.Toplevel(self)
+        popup.title("Interrogate all")
         tk.Label(popup, text="Processing subset images...").grid(row=0,column=0)
         progress_var = tk.DoubleVar()
         progress_var.set(0)
         progress_bar = tk.ttk.Progressbar(popup, variable=progress_var, maximum=100)
-        progress_bar.grid(row=1, column=0)#.pack(fill=tk.X, expand=1, side=tk.BOTTOM)
-        popup.pack_slaves()
-        i = 0
-        for f in self.image_files:
-            #Update progress bar
-            progress_var.set(100 * i / len(self.image_files))
-            popup.update()
-            i = i + 1            
-            self.update_automatic_tags(f, popup=False)
+        progress_bar.grid(row=1, column=0, padx=5, sticky="ew")
+        progress_text = tk.StringVar()
+        progress_text.set("Loading interrogator...")
+        tk.Label(popup, textvar=progress_text).grid(row=2, column=0, padx=5)
+
+        #Decoding, inference and writing happen in stages that overlap.
+        #This window writes the results and shows progress as they come in.
+        pipeline = interrogation.interrogate_pipeline(
+            self.image_files, get_sidecars=self.get_sidecars)
+        tk.Button(popup, text="Cancel", command=pipeline.cancel).grid(
+            row=3, column=0, padx=5, pady=5)
+        popup.wm_protocol("WM_DELETE_WINDOW", pipeline.cancel)
+        popup.transient(self)
+        popup.grab_set()
+
+        pipeline.start()
+        self.after(100, self.poll_interrogate_pipeline,
+                   pipeline, popup, progress_var, progress_text)
+
+    #Write tags the interrogation pipeline has finished and update progress.
+    #Writes stop after a moment so the window stays responsive.
+    def poll_interrogate_pipeline(self, pipeline, popup, progress_var, progress_text):
+        done = False
+        start = time.perf_counter()
+        try:
+            while time.perf_counter() - start < 0.05:
+                message = pipeline.results.get_nowait()
+                if message[0] == "tags":
+                    _, f, automatic_tags = message
+                    try:
+                        self.write_automatic_tags(f, automatic_tags)
+                    except:
+                        print(traceback.format_exc())
+                elif message[0] == "done":
+                    done = True
+                    break
+        except queue.Empty:
+            pass
+
+        interrogated, total, rate, remaining = pipeline.progress()
+        if not done:
+            progress_var.set(100 * interrogated / max(total, 1))
+            if pipeline.stopped.is_set():
+                progress_text.set("Cancelling...")
+            elif interrogated > 0:
+                progress_text.set(
+                    f"{interrogated}/{total} images, {rate:.1f} images/s, "
+                    f"{int(remaining // 60)}:{int(remaining % 60):02d} left")
+            self.after(100, self.poll_interrogate_pipeline,
+                       pipeline, popup, progress_var, progress_text)
+            return
+
+        popup.grab_release()
         popup.destroy()
-        self.update_ui_automatic_tags()
+        if len(self.image_files) > 0:
+            self.set_ui(self.file_index)
 
     #Update automatic tags in all JSON files
     def update_ui_automatic_tags(self, event = None):
-        if not interrogator_ready:
+        if not interrogation.interrogator_ready:
             showwarning(parent=self,
                         title="Not ready",
                         message="The interrogator is not yet ready.")
@@ -3411,21 +3848,19 @@ class lora_tag_helper(TkinterDnD.Tk):
             file = tk.filedialog.askopenfilename(parent=self.root_frame, initialdir=self.path, title="Select an image in the dataset", filetypes =[('Supported images', [f"*{x}" for x in Image.registered_extensions()])])
             if file:
                 file = pathlib.Path(file).absolute()
+        if not file:
+            return
         if file.is_dir():
-            i = 0
-            for f in self.image_files:
-                if str(f).startswith(str(file)):
-                    self.file_index = i
-                    self.set_ui(i)
-                    break
-                i += 1
-        elif file:
-            try:
-                i = self.image_files.index(pathlib.Path(file))
+            i = self.image_positions.find_directory(file)
+            if i is not None:
                 self.file_index = i
                 self.set_ui(i)
-            except ValueError:
-                print(traceback.format_exc())
+        else:
+            i = self.image_positions.find_file(file)
+            if i is not None:
+                self.file_index = i
+                self.set_ui(i)
+            else:
                 print(f"Warning: Supplied path {file} is not an image in the dataset. Ignoring.")
 
 
@@ -3468,6 +3903,14 @@ class lora_tag_helper(TkinterDnD.Tk):
     def quit(self, event = None):
         self.save_unsaved_popup()
 
+        if self.loader is not None:
+            self.loader.stop()
+            self.loader = None
+        if self.thumbnail_browser is not None:
+            self.thumbnail_browser.close()
+        if self.index is not None:
+            self.index.close()
+        self.image_service.stop()
         self.destroy()
 
 
@@ -95,6 +95,27 @@ class Interrogator:
     ]:
         raise NotImplementedError()
 
+    def preprocess(self, image: Image):
+        """
+        converts an image to what interrogate_batch takes,
+        can be called from other threads
+        """
+        return image
+
+    def interrogate_batch(
+        self,
+        images: list,
+        batch_size=1
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        """
+        interrogates images that were passed through preprocess,
+        models that can't run batches do one image at a time
+        """
+        return [self.interrogate(image) for image in images]
+
 
 class DeepDanbooruInterrogator(Interrogator):
     def __init__(self, name: str, project_path: os.PathLike) -> None:
@@ -252,6 +273,14 @@ class WaifuDiffusionInterrogator(Interrogator):
         if not hasattr(self, 'model') or self.model is None:
             self.load()
 
+        image = self.preprocess(image)
+        return self.interrogate_batch([image])[0]
+
+    def preprocess(self, image: Image) -> np.ndarray:
+        # init model
+        if not hasattr(self, 'model') or self.model is None:
+            self.load()
+
         # code for converting the image and running the model is taken from the link below
         # thanks, SmilingWolf!
         # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
@@ -271,21 +300,58 @@ class WaifuDiffusionInterrogator(Interrogator):
 
         image = dbimutils.make_square(image, height)
         image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        return image.astype(np.float32)
 
-        # evaluate model
-        input_name = self.model.get_inputs()[0].name
+    def interrogate_batch(
+        self,
+        images: List[np.ndarray],
+        batch_size=8
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        """
+        runs the model once for every batch_size images,
+        images must come from preprocess
+        """
+        # init model
+        if not hasattr(self, 'model') or self.model is None:
+            self.load()
+
+        model_input = self.model.get_inputs()[0]
         label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
 
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
+        # some exported models have a fixed batch size
+        fixed_batch_size = None
+        if isinstance(model_input.shape[0], int) and model_input.shape[0] > 0:
+            fixed_batch_size = model_input.shape[0]
+            batch_size = min(batch_size, fixed_batch_size)
+        batch_size = max(batch_size, 1)
 
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
+        names = self.tags['name'].tolist()
+        results = []
+        for i in range(0, len(images), batch_size):
+            batch = np.stack(images[i:i + batch_size])
+            count = len(batch)
 
-        # rest are regular tags
-        tags = dict(tags[4:].values)
+            # pad the last batch up to a fixed batch size
+            if fixed_batch_size is not None and count < fixed_batch_size:
+                padding = np.zeros(
+                    (fixed_batch_size - count, *batch.shape[1:]),
+                    dtype=batch.dtype
+                )
+                batch = np.concatenate([batch, padding])
 
-        return ratings, tags
+            # evaluate model
+            confidents = self.model.run([label_name], {model_input.name: batch})[0]
+
+            for c in confidents[:count].tolist():
+                # first 4 items are for rating (general, sensitive, questionable, explicit)
+                ratings = dict(zip(names[:4], c[:4]))
+
+                # rest are regular tags
+                tags = dict(zip(names[4:], c[4:]))
+
+                results.append((ratings, tags))
+
+        return results
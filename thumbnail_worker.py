@@ -0,0 +1,22 @@
+#Runs in thumbnail worker processes. Workers are spawned, so keep this
+#module's imports to PIL and nothing that pulls in the GUI or spacy.
+import os
+import traceback
+from PIL import Image
+
+
+#Write a thumbnail of image_file to thumbnail_file. Only takes and returns
+#plain values so it can be sent between processes.
+def make_thumbnail(image_file, thumbnail_file, size):
+    try:
+        with Image.open(image_file) as image:
+            image.draft("RGB", (size, size))
+            image.thumbnail((size, size), Image.LANCZOS)
+            image = image.convert("RGB")
+            tmp_file = thumbnail_file + ".tmp"
+            image.save(tmp_file, "JPEG", quality=85)
+        os.replace(tmp_file, thumbnail_file)
+        return thumbnail_file
+    except:
+        print(traceback.format_exc())
+        return None
@@ -0,0 +1,106 @@
+import os
+import queue
+import hashlib
+import pathlib
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, isfile
+
+from dataset import file_signature, THUMBNAIL_DIRNAME
+from thumbnail_worker import make_thumbnail
+
+#Longest side of a thumbnail, in pixels
+thumbnail_size = 128
+
+#Most worker processes to make thumbnails with. Each is a separate
+#interpreter, and the GUI needs some of the CPU while they run.
+max_thumbnail_workers = 4
+
+
+#On-disk cache of thumbnails for a dataset. Thumbnails are named after a
+#hash of the image's relative path, mtime and size, so editing or replacing
+#an image gives it a new thumbnail. Missing thumbnails are made in worker
+#processes, and finished ones are posted to the results queue as
+#(image_file, thumbnail_file) for the Tk thread to pick up.
+class thumbnail_cache(object):
+    def __init__(self, root, size = None, workers = None):
+        self.root = pathlib.Path(root).absolute()
+        self.directory = self.root / THUMBNAIL_DIRNAME
+        self.size = size or thumbnail_size
+        self.workers = workers or min(max_thumbnail_workers, os.cpu_count() or 1)
+        self.results = queue.Queue()
+        self.pending = {}
+        #Thumbnails that couldn't be made, e.g. of broken images. They're
+        #named after the image's signature, so a replaced image is retried.
+        self.failed = set()
+        self.lock = threading.RLock()
+        self.pool = None
+
+    def thumbnail_file(self, image_file):
+        h = hashlib.sha1()
+        h.update(os.path.relpath(image_file, self.root).encode())
+        h.update(str(file_signature(image_file)).encode())
+        h.update(str(self.size).encode())
+        return join(str(self.directory), h.hexdigest() + ".jpg")
+
+    #Thumbnail file for an image if it's been made, otherwise None
+    def get(self, image_file):
+        thumbnail_file = self.thumbnail_file(image_file)
+        if isfile(thumbnail_file):
+            return thumbnail_file
+        return None
+
+    #Make thumbnails for images that don't have one yet. Requests for other
+    #images that haven't started yet are dropped, so the images currently
+    #shown come first.
+    def request(self, image_files):
+        wanted = {str(f) for f in image_files}
+        with self.lock:
+            for f, future in list(self.pending.items()):
+                if f not in wanted:
+                    future.cancel()
+
+            for f in wanted:
+                if f in self.pending:
+                    continue
+                thumbnail_file = self.thumbnail_file(f)
+                if thumbnail_file in self.failed:
+                    continue
+                if self.pool is None:
+                    self.directory.mkdir(exist_ok=True)
+                    #Spawn rather than fork, the GUI has threads running
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"))
+                future = self.pool.submit(make_thumbnail, f,
+                                          thumbnail_file, self.size)
+                self.pending[f] = future
+                future.add_done_callback(
+                    lambda future, f=f, t=thumbnail_file:
+                        self.finished(f, t, future))
+
+    def finished(self, image_file, thumbnail_file, future):
+        with self.lock:
+            if self.pending.get(image_file) is future:
+                del self.pending[image_file]
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except:
+            print(traceback.format_exc())
+            return
+        if result is None:
+            with self.lock:
+                self.failed.add(thumbnail_file)
+        else:
+            self.results.put((image_file, result))
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+            self.pending = {}
@@ -0,0 +1,218 @@
+import re
+import threading
+import traceback
+from collections import OrderedDict
+
+#Number of strings whose token counts are remembered
+token_cache_size = 65536
+
+use_clip = False
+tokenizer_ready = False
+#Only the tokenizer is needed to count tokens. It's loaded from the BPE
+#vocabulary shipped with the app, without importing torch or loading the
+#ViT-L-14 model weights, and without network access.
+def import_tokenizer_reqs():
+    global tokenizer_ready
+    try:
+        try:
+            global tokenizer, use_clip
+            print("Importing Tokenizer...")
+            from clip_tokenizer import get_tokenizer
+            tokenizer = get_tokenizer()
+
+            use_clip = True
+            print("Done!")
+
+        except:
+            print("Done!")
+            print(traceback.format_exc())
+            print("Couldn't load the clip tokenizer, falling back to tiktoken. Token count will be less accurate, and tiktoken may need to download its encoding.")
+            global tiktoken
+            import tiktoken
+    except:
+        print(traceback.format_exc())
+    tokenizer_ready = True
+
+#Return the number of tokens in string, not counting the start/end tokens.
+#Exact with the clip tokenizer, which encodes the whole string in one pass
+#without the 77 token context limit.
+def count_tokens(string: str, encoding_name: str= None) -> int:
+    if use_clip:
+        return tokenizer.count(string)
+    else:
+        encoding = get_encoding(encoding_name)
+        num_tokens = len(encoding.encode(string))
+        return num_tokens
+
+
+#tiktoken encodings already loaded, by name
+encodings = {}
+
+
+def get_encoding(encoding_name):
+    if encoding_name not in encodings:
+        encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+    return encodings[encoding_name]
+
+
+#CLIP tokens never span whitespace, so a caption split at the whitespace
+#after each comma has exactly as many tokens as its parts put together
+component_separator = re.compile(r"(?<=,)\s+")
+
+
+#Least recently used cache of token counts, keyed by tokenizer and string.
+#With the clip tokenizer, captions are counted one comma separated tag at a
+#time, so editing a tag only counts that tag again.
+class token_count_cache(object):
+    def __init__(self, max_entries = None):
+        self.max_entries = max_entries or token_cache_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        with self.lock:
+            count = self.entries.get(key)
+            if count is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return count
+
+    def store(self, key, count):
+        with self.lock:
+            self.entries[key] = count
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def cached_count(self, backend, string, encoding_name):
+        key = (backend, string)
+        count = self.lookup(key)
+        if count is None:
+            count = count_tokens(string, encoding_name)
+            self.store(key, count)
+        return count
+
+    def count(self, string, encoding_name = None):
+        if not use_clip:
+            return self.cached_count(encoding_name, string, encoding_name)
+
+        key = ("clip", string)
+        count = self.lookup(key)
+        if count is None:
+            count = sum(self.cached_count("clip", c, encoding_name)
+                        for c in component_separator.split(string))
+            self.store(key, count)
+        return count
+
+    #Counts of many strings at once. With the clip tokenizer, each distinct
+    #tag is tokenized once however many captions it appears in, and the
+    #cache is only locked once to look them all up.
+    def count_many(self, strings, encoding_name = None):
+        if not use_clip:
+            return [self.count(s, encoding_name) for s in strings]
+
+        components = [component_separator.split(s) for s in strings]
+        counts = {}
+        with self.lock:
+            for c in (c for cs in components for c in cs):
+                if c in counts:
+                    continue
+                counts[c] = self.entries.get(("clip", c))
+                if counts[c] is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.entries.move_to_end(("clip", c))
+
+        for c, count in counts.items():
+            if count is None:
+                counts[c] = count_tokens(c, encoding_name)
+                self.store(("clip", c), counts[c])
+
+        return [sum(counts[c] for c in cs) for cs in components]
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+
+#Shared by everything that counts tokens
+token_counts = token_count_cache()
+
+
+#Number of tokens in string, remembered for strings (and tags) seen before
+def num_tokens_from_string(string: str, encoding_name: str= None) -> int:
+    """Returns the number of tokens in a text string."""
+    return token_counts.count(string, encoding_name)
+
+
+#Number of tokens in each of strings
+def num_tokens_many(strings, encoding_name: str= None):
+    return token_counts.count_many(strings, encoding_name)
+
+
+#Tokens of string as (token, start, end), where string[start:end] is the
+#text the token came from. Only available with the clip tokenizer.
+def token_offsets(string: str):
+    return tokenizer.encode_with_offsets(string)
+
+
+#Cut string to at most max_tokens tokens, dropping whole words from the end.
+#With to_tags, it's cut after the last whole comma separated tag instead.
+def truncate_string_to_max_tokens(string : str, max_tokens = 75, to_tags = False):
+    string = string.strip()
+    if use_clip:
+        from clip_tokenizer import fix_text
+        if fix_text(string) == string:
+            string = truncate_at_offsets(string, max_tokens, to_tags)
+        else:
+            #Offsets would index into the fixed text, which isn't what gets
+            #written out
+            string = truncate_by_words(string, max_tokens, to_tags)
+    else:
+        string = truncate_by_words(string, max_tokens, to_tags)
+
+    while string.endswith(","):
+        string = string[:-1]
+    return string
+
+
+#Tokenize once and cut where the first token that doesn't fit starts
+def truncate_at_offsets(string, max_tokens, to_tags):
+    offsets = token_offsets(string)
+    if len(offsets) <= max_tokens:
+        return string
+
+    cut = offsets[max_tokens][1]
+    if to_tags and "," in string[:cut]:
+        cut = string.rindex(",", 0, cut)
+    elif not string[cut - 1].isspace() and not string[cut].isspace():
+        #Don't keep part of a word
+        space = max(string.rfind(c, 0, cut) for c in " \t\n\r")
+        if space >= 0:
+            cut = space
+    return " ".join(string[:cut].split())
+
+
+#Drop words (or tags) from the end until the string fits. Only used with
+#tiktoken, which doesn't give offsets.
+def truncate_by_words(string, max_tokens, to_tags):
+    separator = "," if to_tags else None
+    joiner = "," if to_tags else " "
+    while num_tokens_from_string(string.strip(), "gpt2") > max_tokens:
+        parts = string.split(separator)
+        if to_tags and len(parts) == 1:
+            separator, joiner = None, " "
+            continue
+        string = joiner.join(parts[:-1])
+    return string.strip()